@@ -1,6 +1,7 @@
-from flask import Flask, render_template, jsonify
-import psycopg2
+from flask import Flask, render_template, request, Response
+from flask_compress import Compress
 from psycopg2.extras import RealDictCursor
+from psycopg2.pool import ThreadedConnectionPool
 import os
 from dotenv import load_dotenv
 from google.analytics.data_v1beta import BetaAnalyticsDataClient
@@ -9,14 +10,28 @@ from google.analytics.data_v1beta.types import (
     Dimension,
     Metric
 )
-from datetime import datetime
+from datetime import datetime, timezone
+from decimal import Decimal
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import wraps
+import csv
+import io
 import json
+import orjson
+import threading
+import time
 
 # Load biến môi trường
 load_dotenv()
 
 app = Flask(__name__)
 
+# Nén JSON response (br/gzip) cho các payload lớn hơn 500 bytes
+app.config['COMPRESS_ALGORITHM'] = ['br', 'gzip']
+app.config['COMPRESS_MIN_SIZE'] = 500
+Compress(app)
+
 # Cấu hình Database
 DB_CONFIG = {
     'host': os.getenv('DB_HOST', 'localhost'),
@@ -48,9 +63,98 @@ VIETNAM_CITIES = {
     'Vinh': {'lat': 18.6796, 'lng': 105.6813, 'name': 'Vinh'},
 }
 
-def get_db_connection():
-    """Tạo kết nối tới PostgreSQL"""
-    return psycopg2.connect(**DB_CONFIG)
+# Tính sẵn cho save_to_database: tập tên city và tuple (province, city, lat, lng)
+VIETNAM_CITY_KEYS = frozenset(VIETNAM_CITIES)
+VIETNAM_CITY_ROWS = {
+    city: (info['name'], city, info['lat'], info['lng'])
+    for city, info in VIETNAM_CITIES.items()
+}
+
+# Pool kết nối dùng chung cho các route, tạo lần đầu khi cần
+_db_pool = None
+
+def get_db_pool():
+    """Trả về connection pool PostgreSQL (khởi tạo lazily)"""
+    global _db_pool
+    if _db_pool is None:
+        _db_pool = ThreadedConnectionPool(1, 16, **DB_CONFIG)
+    return _db_pool
+
+@contextmanager
+def db_connection():
+    """Mượn một kết nối từ pool và trả lại khi xong"""
+    pool = get_db_pool()
+    conn = pool.getconn()
+    # Các route chỉ chạy một vài SELECT: autocommit bỏ được round-trip BEGIN/ROLLBACK
+    conn.autocommit = True
+    try:
+        yield conn
+    finally:
+        pool.putconn(conn)
+
+def _json_default(obj):
+    """Serialize các kiểu orjson không hỗ trợ sẵn (NUMERIC từ PostgreSQL)"""
+    if isinstance(obj, Decimal):
+        return str(obj)
+    raise TypeError
+
+def ojson(data):
+    """Tạo JSON response bằng orjson (nhanh hơn jsonify, hỗ trợ datetime sẵn)"""
+    return Response(orjson.dumps(data, default=_json_default), mimetype='application/json')
+
+# Cache response của các API chỉ đọc (dữ liệu chỉ đổi khi refresh)
+RESPONSE_CACHE_TTL = 30  # giây
+_response_cache = {}
+_response_cache_lock = threading.Lock()
+
+def cached_response(ttl=RESPONSE_CACHE_TTL):
+    """Decorator cache JSON body của route theo request.path trong `ttl` giây"""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            key = request.path
+            now = time.monotonic()
+            with _response_cache_lock:
+                entry = _response_cache.get(key)
+            if entry and entry[0] > now:
+                return Response(entry[1], mimetype='application/json')
+            
+            response = app.make_response(view(*args, **kwargs))
+            if response.status_code == 200:
+                with _response_cache_lock:
+                    _response_cache[key] = (now + ttl, response.get_data())
+            return response
+        return wrapper
+    return decorator
+
+def clear_response_cache():
+    """Xóa toàn bộ cache response (gọi sau khi refresh dữ liệu)"""
+    with _response_cache_lock:
+        _response_cache.clear()
+
+def report_rows(response):
+    """
+    Đọc response GA4 (1 dimension, 1 metric) thành list (dimension, int(metric))
+    Chỉ truy cập các field protobuf một lần cho mỗi dòng
+    """
+    return [
+        (row.dimension_values[0].value, int(row.metric_values[0].value))
+        for row in response.rows
+    ]
+
+def copy_rows(cursor, table, columns, rows):
+    """Ghi nhiều dòng vào bảng bằng COPY FROM STDIN (CSV)"""
+    if not rows:
+        return
+    
+    buf = io.StringIO()
+    csv.writer(buf).writerows(rows)
+    buf.seek(0)
+    
+    cursor.copy_expert(
+        f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)",
+        buf
+    )
 
 def fetch_ga4_realtime_data():
     """Lấy dữ liệu realtime từ GA4"""
@@ -93,29 +197,33 @@ def fetch_ga4_realtime_data():
         metrics=[Metric(name="screenPageViews")]
     )
     
-    # Thực hiện các request
-    response_5min_realtime = client.run_realtime_report(request_5min_realtime)
-    response_30min_realtime = client.run_realtime_report(request_30min_realtime)
-    response_1min_city = client.run_realtime_report(request_1min_city)
-    response_device = client.run_realtime_report(request_device)
-    response_page = client.run_realtime_report(request_page)
-    
-    return {
-        'users_5min_realtime': response_5min_realtime,
-        'users_30min_realtime': response_30min_realtime,
-        'users_1min_city': response_1min_city,
-        'by_device': response_device,  # Đổi từ by_source sang by_device
-        'by_page': response_page
+    requests_by_key = {
+        'users_5min_realtime': request_5min_realtime,
+        'users_30min_realtime': request_30min_realtime,
+        'users_1min_city': request_1min_city,
+        'by_device': request_device,  # Đổi từ by_source sang by_device
+        'by_page': request_page
     }
+    
+    # Thực hiện các request song song (client gRPC thread-safe)
+    with ThreadPoolExecutor(max_workers=len(requests_by_key)) as executor:
+        futures = {
+            key: executor.submit(client.run_realtime_report, req)
+            for key, req in requests_by_key.items()
+        }
+        return {key: future.result() for key, future in futures.items()}
 
 def save_to_database(ga4_data):
     """Lưu dữ liệu GA4 vào PostgreSQL"""
-    conn = get_db_connection()
+    pool = get_db_pool()
+    conn = pool.getconn()
+    # Toàn bộ refresh chạy trong một transaction, commit một lần ở cuối
+    conn.autocommit = False
     cursor = conn.cursor()
     
     try:
-        # Xóa dữ liệu cũ
-        cursor.execute("TRUNCATE realtime_active_users, user_by_location, user_by_source, views_by_page")
+        # Dữ liệu được ghi đè mỗi lần refresh nên không cần chờ fsync khi commit
+        cursor.execute("SET LOCAL synchronous_commit = OFF")
         
         res_5m = ga4_data['users_5min_realtime']
         res_30m = ga4_data['users_30min_realtime']
@@ -123,57 +231,43 @@ def save_to_database(ga4_data):
         active_users_5m = int(res_5m.rows[0].metric_values[0].value) if res_5m.rows else 0
         active_users_30m = int(res_30m.rows[0].metric_values[0].value) if res_30m.rows else 0
         
+        # Xóa dữ liệu cũ và lưu tổng active users trong cùng một round-trip
         cursor.execute("""
-         INSERT INTO realtime_active_users (active_users_5m, recorded_at, active_users_30m)
-         VALUES (%s, %s, %s)
-    # """, (
-         active_users_5m,
-         datetime.now(timezone.utc),
-         active_users_30m
-     ))
+            TRUNCATE realtime_active_users, user_by_location, user_by_source, views_by_page;
+            INSERT INTO realtime_active_users (active_users_5m, active_users_30m, recorded_at)
+            VALUES (%s, %s, %s);
+        """, (
+            active_users_5m,
+            active_users_30m,
+            datetime.now(timezone.utc)
+        ))
         
         # Lưu dữ liệu location
-        users_1min_dict = {}
-        for row in ga4_data['users_1min_city'].rows:
-            city = row.dimension_values[0].value
-            users = int(row.metric_values[0].value)
-            users_1min_dict[city] = users
+        users_1min_dict = dict(report_rows(ga4_data['users_1min_city']))
         
         # Kết hợp và insert vào DB
-        all_cities = set(users_1min_dict.keys())
-        
-        for city in all_cities:
-            if city in VIETNAM_CITIES:
-                city_info = VIETNAM_CITIES[city]
-                cursor.execute("""
-                    INSERT INTO user_by_location 
-                    (province, city, latitude, longitude, active_users_5min, active_users_30min)
-                    VALUES (%s, %s, %s, %s, %s, %s)
-                """, (
-                    city_info['name'], 
-                    city, 
-                    city_info['lat'], 
-                    city_info['lng'],
-                    users_1min_dict.get(city, 0)
-                ))
+        location_rows = [
+            (*VIETNAM_CITY_ROWS[city], users)
+            for city, users in users_1min_dict.items()
+            if city in VIETNAM_CITY_KEYS
+        ]
+        copy_rows(cursor, 'user_by_location',
+                  ('province', 'city', 'latitude', 'longitude', 'active_users_5min'),
+                  location_rows)
         
         # Lưu dữ liệu device (thay cho source)
-        for row in ga4_data['by_device'].rows:
-            device = row.dimension_values[0].value
-            users = int(row.metric_values[0].value)
-            cursor.execute("""
-                INSERT INTO user_by_source (source, active_users)
-                VALUES (%s, %s)
-            """, (device, users))
+        device_rows = report_rows(ga4_data['by_device'])
+        copy_rows(cursor, 'user_by_source', ('source', 'active_users'), device_rows)
         
         # Lưu dữ liệu page views
-        for row in ga4_data['by_page'].rows:
-            page_name = row.dimension_values[0].value
-            views = int(row.metric_values[0].value)
-            cursor.execute("""
-                INSERT INTO views_by_page (page_title, screen_name, views)
-                VALUES (%s, %s, %s)
-            """, (page_name, page_name, views))
+        page_rows = [
+            (page_name, page_name, views)
+            for page_name, views in report_rows(ga4_data['by_page'])
+        ]
+        copy_rows(cursor, 'views_by_page', ('page_title', 'screen_name', 'views'), page_rows)
+        
+        # Cập nhật thống kê để planner dùng index sau khi nạp lại bảng
+        cursor.execute("ANALYZE user_by_location, user_by_source, views_by_page")
         
         conn.commit()
         print("✓ Data saved successfully!")
@@ -184,7 +278,26 @@ def save_to_database(ga4_data):
         raise
     finally:
         cursor.close()
-        conn.close()
+        pool.putconn(conn)
+
+# Chỉ cho phép một lần refresh GA4 chạy nền tại một thời điểm
+_refresh_lock = threading.Lock()
+
+def run_refresh():
+    """Fetch GA4 và lưu DB ở background thread; giải phóng _refresh_lock khi xong"""
+    try:
+        ga4_data = fetch_ga4_realtime_data()
+        save_to_database(ga4_data)
+        clear_response_cache()
+    except Exception as e:
+        print(f"✗ Background refresh failed: {e}")
+    finally:
+        _refresh_lock.release()
+
+def refresh_top_posts_view():
+    """Tính lại materialized view fb_top_posts sau khi sync Facebook"""
+    with db_connection() as conn, conn.cursor() as cursor:
+        cursor.execute("REFRESH MATERIALIZED VIEW CONCURRENTLY fb_top_posts")
 
 # Routes
 @app.route('/')
@@ -193,191 +306,154 @@ def index():
     return render_template('index.html')
 
 @app.route('/api/map-data')
+@cached_response()
 def get_map_data():
     """API trả về dữ liệu cho bản đồ"""
-    conn = get_db_connection()
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
-    
-    cursor.execute("""
-        SELECT province, city, latitude, longitude, 
-               active_users_5min, active_users_30min
-        FROM user_by_location
-        ORDER BY active_users_30min DESC
-    """)
-    
-    data = cursor.fetchall()
-    cursor.close()
-    conn.close()
+    with db_connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cursor:
+        cursor.execute("""
+            SELECT province, city, latitude, longitude, 
+                   active_users_5min, active_users_30min
+            FROM user_by_location
+            ORDER BY active_users_30min DESC
+        """)
+        data = cursor.fetchall()
     
-    return jsonify(data)
+    return ojson(data)
 
 @app.route('/api/active-users')
+@cached_response()
 def get_active_users():
     """API trả về tổng số active users"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute("SELECT SUM(active_users_5min) FROM user_by_location")
-    users_5min = cursor.fetchone()[0] or 0
-    
-    cursor.execute("SELECT SUM(active_users_30min) FROM user_by_location")
-    users_30min = cursor.fetchone()[0] or 0
-    
-    cursor.close()
-    conn.close()
+    with db_connection() as conn, conn.cursor() as cursor:
+        cursor.execute("""
+            SELECT COALESCE(SUM(active_users_5min), 0),
+                   COALESCE(SUM(active_users_30min), 0)
+            FROM user_by_location
+        """)
+        users_5min, users_30min = cursor.fetchone()
     
-    return jsonify({
+    return ojson({
         'users_5min': users_5min,
         'users_30min': users_30min
     })
 
 @app.route('/api/users-by-source')
+@cached_response()
 def get_users_by_source():
     """API trả về users theo device/source"""
-    conn = get_db_connection()
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
-    
-    cursor.execute("""
-        SELECT source, active_users
-        FROM user_by_source
-        ORDER BY active_users DESC
-        LIMIT 10
-    """)
-    
-    data = cursor.fetchall()
-    cursor.close()
-    conn.close()
+    with db_connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cursor:
+        cursor.execute("""
+            SELECT source, active_users
+            FROM user_by_source
+            ORDER BY active_users DESC
+            LIMIT 10
+        """)
+        data = cursor.fetchall()
     
-    return jsonify(data)
+    return ojson(data)
 
 @app.route('/api/views-by-page')
+@cached_response()
 def get_views_by_page():
     """API trả về views theo page"""
-    conn = get_db_connection()
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
-    
-    cursor.execute("""
-        SELECT page_title, screen_name, views
-        FROM views_by_page
-        ORDER BY views DESC
-        LIMIT 10
-    """)
-    
-    data = cursor.fetchall()
-    cursor.close()
-    conn.close()
+    with db_connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cursor:
+        cursor.execute("""
+            SELECT page_title, screen_name, views
+            FROM views_by_page
+            ORDER BY views DESC
+            LIMIT 10
+        """)
+        data = cursor.fetchall()
     
-    return jsonify(data)
+    return ojson(data)
 
 @app.route('/api/refresh')
 def refresh_data():
-    """API để refresh dữ liệu từ GA4"""
-    try:
-        ga4_data = fetch_ga4_realtime_data()
-        save_to_database(ga4_data)
-        return jsonify({'status': 'success', 'message': 'Data refreshed successfully'})
-    except Exception as e:
-        return jsonify({'status': 'error', 'message': str(e)}), 500
+    """API để refresh dữ liệu từ GA4 (chạy nền, trả về 202 ngay)"""
+    if not _refresh_lock.acquire(blocking=False):
+        return ojson({'status': 'running', 'message': 'Refresh already in progress'}), 202
+    
+    threading.Thread(target=run_refresh, daemon=True).start()
+    return ojson({'status': 'queued', 'message': 'Data refresh started'}), 202
 
 # Facebook API Endpoints
 @app.route('/api/facebook/summary')
+@cached_response()
 def get_facebook_summary():
     """API trả về tổng hợp metrics Facebook 7 ngày"""
-    conn = get_db_connection()
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
-    
     try:
-        cursor.execute("""
-            SELECT 
-                SUM(total_views) as total_views_7d,
-                SUM(total_viewers) as total_viewers_7d,
-                SUM(total_engagement) as total_engagement_7d,
-                ROUND(AVG(engagement_rate), 2) as avg_engagement_rate
-            FROM facebook_metrics_summary
-            WHERE metric_date >= CURRENT_DATE - INTERVAL '7 days'
-        """)
-        
-        summary = cursor.fetchone()
-        
-        cursor.close()
-        conn.close()
+        with db_connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute("""
+                SELECT 
+                    SUM(total_views) as total_views_7d,
+                    SUM(total_viewers) as total_viewers_7d,
+                    SUM(total_engagement) as total_engagement_7d,
+                    ROUND(AVG(engagement_rate), 2) as avg_engagement_rate
+                FROM facebook_metrics_summary
+                WHERE metric_date >= CURRENT_DATE - INTERVAL '7 days'
+            """)
+            summary = cursor.fetchone()
         
-        return jsonify(summary or {
+        return ojson(summary or {
             'total_views_7d': 0,
             'total_viewers_7d': 0,
             'total_engagement_7d': 0,
             'avg_engagement_rate': 0
         })
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return ojson({'error': str(e)}), 500
 
 @app.route('/api/facebook/daily-metrics')
+@cached_response()
 def get_facebook_daily_metrics():
     """API trả về metrics theo ngày (7 ngày)"""
-    conn = get_db_connection()
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
-    
     try:
-        cursor.execute("""
-            SELECT 
-                metric_date,
-                total_views,
-                total_viewers,
-                total_engagement,
-                engagement_rate
-            FROM facebook_metrics_summary
-            WHERE metric_date >= CURRENT_DATE - INTERVAL '7 days'
-            ORDER BY metric_date ASC
-        """)
-        
-        data = cursor.fetchall()
-        cursor.close()
-        conn.close()
-        
-        # Format dates cho JSON
-        for row in data:
-            row['metric_date'] = row['metric_date'].isoformat()
+        with db_connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute("""
+                SELECT 
+                    metric_date,
+                    total_views,
+                    total_viewers,
+                    total_engagement,
+                    engagement_rate
+                FROM facebook_metrics_summary
+                WHERE metric_date >= CURRENT_DATE - INTERVAL '7 days'
+                ORDER BY metric_date ASC
+            """)
+            data = cursor.fetchall()
         
-        return jsonify(data)
+        return ojson(data)
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return ojson({'error': str(e)}), 500
 
 @app.route('/api/facebook/top-posts')
+@cached_response()
 def get_facebook_top_posts():
     """API trả về top posts theo engagement"""
-    conn = get_db_connection()
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
-    
     try:
-        cursor.execute("""
-            SELECT 
-                post_id,
-                post_message,
-                post_type,
-                created_time,
-                post_impressions,
-                post_engaged_users,
-                post_reactions,
-                post_comments,
-                post_shares,
-                (post_reactions + post_comments + post_shares) as total_engagement
-            FROM facebook_post_insights
-            WHERE created_time >= CURRENT_TIMESTAMP - INTERVAL '7 days'
-            ORDER BY total_engagement DESC
-            LIMIT 10
-        """)
-        
-        data = cursor.fetchall()
-        cursor.close()
-        conn.close()
-        
-        # Format dates
-        for row in data:
-            row['created_time'] = row['created_time'].isoformat() if row['created_time'] else None
+        with db_connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cursor:
+            # fb_top_posts được tính sẵn khi refresh (migrations/002_fb_top_posts_view.sql)
+            cursor.execute("""
+                SELECT 
+                    post_id,
+                    post_message,
+                    post_type,
+                    created_time,
+                    post_impressions,
+                    post_engaged_users,
+                    post_reactions,
+                    post_comments,
+                    post_shares,
+                    total_engagement
+                FROM fb_top_posts
+                ORDER BY total_engagement DESC
+                LIMIT 10
+            """)
+            data = cursor.fetchall()
         
-        return jsonify(data)
+        return ojson(data)
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return ojson({'error': str(e)}), 500
 
 @app.route('/api/facebook/refresh')
 def refresh_facebook_data():
@@ -385,9 +461,11 @@ def refresh_facebook_data():
     try:
         from save_facebook_data import fetch_and_save_all_facebook_data
         fetch_and_save_all_facebook_data()
-        return jsonify({'status': 'success', 'message': 'Facebook data refreshed successfully'})
+        refresh_top_posts_view()
+        clear_response_cache()
+        return ojson({'status': 'success', 'message': 'Facebook data refreshed successfully'})
     except Exception as e:
-        return jsonify({'status': 'error', 'message': str(e)}), 500
+        return ojson({'status': 'error', 'message': str(e)}), 500
 
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
@@ -5,12 +5,34 @@ Thêm method get_page_current_stats() nếu chưa có
 """
 
 import os
-import re
+import ast
 
 def check_method_exists(content):
     """Kiểm tra method đã tồn tại chưa"""
     return 'def get_page_current_stats' in content
 
+def find_method_end(content, method_name):
+    """
+    Tìm vị trí cuối dòng cuối cùng của method bằng ast
+    
+    Returns:
+        Offset trong content (trước ký tự xuống dòng), hoặc None nếu không thấy
+    """
+    try:
+        tree = ast.parse(content)
+    except SyntaxError as e:
+        print(f"⚠️  Không parse được file: {e}")
+        return None
+    
+    for node in ast.walk(tree):
+        if isinstance(node, ast.FunctionDef) and node.name == method_name:
+            lines = content.splitlines(keepends=True)
+            last_line = lines[node.end_lineno - 1]
+            line_start = sum(len(line) for line in lines[:node.end_lineno - 1])
+            return line_start + len(last_line.rstrip('\r\n'))
+    
+    return None
+
 def add_method_to_file(filename='facebook_api.py'):
     """Thêm method vào file"""
     
@@ -28,11 +50,9 @@ def add_method_to_file(filename='facebook_api.py'):
         return True
     
     # Tìm vị trí để insert (sau method get_page_summary_metrics)
-    pattern = r'(def get_page_summary_metrics\(self\):.*?return insights)'
-    
-    match = re.search(pattern, content, re.DOTALL)
+    insert_pos = find_method_end(content, 'get_page_summary_metrics')
     
-    if not match:
+    if insert_pos is None:
         print("⚠️  Không tìm thấy method get_page_summary_metrics()")
         print("    Vui lòng copy toàn bộ file mới từ artifact")
         return False
@@ -59,7 +79,6 @@ def add_method_to_file(filename='facebook_api.py'):
             return {}'''
     
     # Insert method mới
-    insert_pos = match.end()
     new_content = content[:insert_pos] + new_method + content[insert_pos:]
     
     # Backup file cũ
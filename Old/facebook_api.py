@@ -6,13 +6,28 @@ Updated: Chỉ sử dụng active metrics (no deprecated)
 """
 
 import os
+import time
+import hashlib
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
+from concurrent.futures import ThreadPoolExecutor
 import json
 
 load_dotenv()
 
+# Số request Graph API chạy song song khi lấy insights của posts
+POST_FETCH_WORKERS = 16
+
+# Timeout (connect, read) cho mỗi request Graph API
+REQUEST_TIMEOUT = (3, 10)
+
+# Cache response Graph API trên đĩa cho dữ liệu lịch sử (insights theo ngày)
+CACHE_DIR = os.getenv('FACEBOOK_CACHE_DIR', os.path.expanduser('~/.cache/fbapi'))
+CACHE_TTL_SECONDS = 6 * 3600
+
 class FacebookAPI:
     def __init__(self):
         self.access_token = os.getenv('FACEBOOK_PAGE_ACCESS_TOKEN')
@@ -21,20 +36,75 @@ class FacebookAPI:
         
         if not self.access_token or not self.page_id:
             raise ValueError("Missing FACEBOOK_PAGE_ACCESS_TOKEN or FACEBOOK_PAGE_ID in .env")
+        
+        # Dùng chung session để giữ kết nối keep-alive tới Graph API
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(
+            pool_connections=8,
+            pool_maxsize=32,
+            max_retries=Retry(
+                total=3,
+                backoff_factor=0.2,
+                status_forcelist=[429, 500, 502, 503, 504]
+            )
+        ))
+    
+    def _cache_path(self, endpoint, params):
+        """Đường dẫn file cache cho (endpoint, params), không gồm access_token"""
+        key = json.dumps([self.base_url, endpoint, sorted(params.items())], default=str)
+        return os.path.join(CACHE_DIR, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json')
     
-    def _make_request(self, endpoint, params=None):
-        """Helper để gọi Facebook Graph API"""
+    def _read_cache(self, path, ttl):
+        """Đọc cache nếu còn hạn, ngược lại trả về None"""
+        try:
+            if time.time() - os.path.getmtime(path) > ttl:
+                return None
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+    
+    def _write_cache(self, path, data):
+        """Ghi cache (ghi file tạm rồi rename để không bị đọc dở)"""
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Warning: could not write Facebook API cache: {e}")
+    
+    def _make_request(self, endpoint, params=None, cache_ttl=None):
+        """
+        Helper để gọi Facebook Graph API
+        
+        Args:
+            endpoint: Endpoint Graph API (không gồm base_url)
+            params: Query params
+            cache_ttl: Nếu có, cache response trên đĩa trong N giây
+        """
         url = f"{self.base_url}/{endpoint}"
         
         if params is None:
             params = {}
         
+        cache_path = None
+        if cache_ttl:
+            cache_path = self._cache_path(endpoint, params)
+            cached = self._read_cache(cache_path, cache_ttl)
+            if cached is not None:
+                return cached
+        
         params['access_token'] = self.access_token
         
         try:
-            response = requests.get(url, params=params)
+            response = self.session.get(url, params=params, timeout=REQUEST_TIMEOUT)
             response.raise_for_status()
-            return response.json()
+            data = response.json()
+            if cache_path:
+                self._write_cache(cache_path, data)
+            return data
         except requests.exceptions.RequestException as e:
             print(f"Error calling Facebook API: {e}")
             if hasattr(e.response, 'text'):
@@ -63,7 +133,8 @@ class FacebookAPI:
             'period': 'day'
         }
         
-        data = self._make_request(endpoint, params)
+        # Key gồm since/until nên cache tự đổi mỗi ngày
+        data = self._make_request(endpoint, params, cache_ttl=CACHE_TTL_SECONDS)
         return data
     
     def get_page_posts(self, limit=100):
@@ -102,6 +173,7 @@ class FacebookAPI:
         }
         
         try:
+            # Không cache: insights lifetime của post 7 ngày gần nhất vẫn đang tăng
             data = self._make_request(endpoint, params)
             return data
         except Exception as e:
@@ -137,42 +209,55 @@ class FacebookAPI:
             'post_clicks'
         ]
         
-        posts_with_insights = []
-        
-        for post in posts:
-            post_id = post['id']
-            
-            # Lấy insights
-            insights = self.get_post_insights(post_id, post_metrics)
-            
-            # Lấy engagement metrics từ post object
-            engagement_endpoint = post_id
-            engagement_params = {
-                'fields': 'shares,comments.summary(true),reactions.summary(true)'
-            }
-            
-            try:
-                engagement_data = self._make_request(engagement_endpoint, engagement_params)
-            except:
-                engagement_data = {}
-            
-            # Kết hợp dữ liệu
-            post_info = {
-                'id': post_id,
-                'message': post.get('message', ''),
-                'type': post.get('type', ''),
-                'created_time': post.get('created_time', ''),
-                'permalink_url': post.get('permalink_url', ''),
-                'insights': insights.get('data', []),
-                'shares': engagement_data.get('shares', {}).get('count', 0),
-                'comments': engagement_data.get('comments', {}).get('summary', {}).get('total_count', 0),
-                'reactions': engagement_data.get('reactions', {}).get('summary', {}).get('total_count', 0)
-            }
-            
-            posts_with_insights.append(post_info)
+        # Mỗi post cần 2 request độc lập -> chạy song song theo post
+        with ThreadPoolExecutor(max_workers=POST_FETCH_WORKERS) as executor:
+            posts_with_insights = list(executor.map(
+                lambda post: self._get_post_with_insights(post, post_metrics),
+                posts
+            ))
         
         return posts_with_insights
     
+    def _get_post_with_insights(self, post, post_metrics):
+        """
+        Lấy insights + engagement cho một post và kết hợp dữ liệu
+        
+        Args:
+            post: Dict post từ endpoint /posts
+            post_metrics: List các metric cần lấy
+        
+        Returns:
+            Dict post với insights đầy đủ
+        """
+        post_id = post['id']
+        
+        # Lấy insights
+        insights = self.get_post_insights(post_id, post_metrics)
+        
+        # Lấy engagement metrics từ post object
+        engagement_endpoint = post_id
+        engagement_params = {
+            'fields': 'shares,comments.summary(true),reactions.summary(true)'
+        }
+        
+        try:
+            engagement_data = self._make_request(engagement_endpoint, engagement_params)
+        except:
+            engagement_data = {}
+        
+        # Kết hợp dữ liệu
+        return {
+            'id': post_id,
+            'message': post.get('message', ''),
+            'type': post.get('type', ''),
+            'created_time': post.get('created_time', ''),
+            'permalink_url': post.get('permalink_url', ''),
+            'insights': insights.get('data', []),
+            'shares': engagement_data.get('shares', {}).get('count', 0),
+            'comments': engagement_data.get('comments', {}).get('summary', {}).get('total_count', 0),
+            'reactions': engagement_data.get('reactions', {}).get('summary', {}).get('total_count', 0)
+        }
+    
     def get_page_summary_metrics(self):
         """
         Lấy metrics tổng quan của page trong 7 ngày
@@ -236,6 +321,18 @@ class FacebookAPI:
             return False
 
 
+# Map metric name Facebook -> cột trong facebook_page_insights (chỉ active metrics)
+INSIGHT_METRIC_COLUMNS = {
+    'page_views_total': 'page_views',
+    'page_impressions': 'page_impressions',
+    'page_impressions_unique': 'page_impressions_unique',
+    'page_post_engagements': 'page_post_engagements',
+    'page_posts_impressions': 'page_posts_impressions',
+    'page_actions_post_reactions_total': 'page_reactions',
+    'page_video_views': 'page_video_views',
+}
+
+
 def format_insights_for_database(insights_data):
     """
     Format dữ liệu insights từ Facebook API sang format cho database
@@ -258,28 +355,15 @@ def format_insights_for_database(insights_data):
     for metric in insights_data['data']:
         metric_name = metric['name']
         
+        column = INSIGHT_METRIC_COLUMNS.get(metric_name)
+        
         for value_item in metric.get('values', []):
             date = value_item.get('end_time', '').split('T')[0]
             value = value_item.get('value', 0)
             
-            if date not in data_by_date:
-                data_by_date[date] = {'insight_date': date}
-            
-            # Map metric names (chỉ active metrics)
-            if metric_name == 'page_views_total':
-                data_by_date[date]['page_views'] = value
-            elif metric_name == 'page_impressions':
-                data_by_date[date]['page_impressions'] = value
-            elif metric_name == 'page_impressions_unique':
-                data_by_date[date]['page_impressions_unique'] = value
-            elif metric_name == 'page_post_engagements':
-                data_by_date[date]['page_post_engagements'] = value
-            elif metric_name == 'page_posts_impressions':
-                data_by_date[date]['page_posts_impressions'] = value
-            elif metric_name == 'page_actions_post_reactions_total':
-                data_by_date[date]['page_reactions'] = value
-            elif metric_name == 'page_video_views':
-                data_by_date[date]['page_video_views'] = value
+            row = data_by_date.setdefault(date, {'insight_date': date})
+            if column:
+                row[column] = value
     
     formatted_data = list(data_by_date.values())
     return formatted_data
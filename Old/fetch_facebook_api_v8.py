@@ -1,9 +1,29 @@
 import os
+import sys
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import psycopg2
+import psycopg2.extras
 from datetime import datetime, timedelta, date
 from dotenv import load_dotenv
 
+# orjson parse nhanh hơn json chuẩn; fallback nếu chưa cài
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    import json
+    json_loads = json.loads
+
+# end_time của Graph API dạng 2024-01-01T08:00:00+0000: Python 3.11+ fromisoformat
+# đọc trực tiếp (kể cả 'Z'), bản cũ hơn dùng strptime thay vì replace chuỗi mỗi dòng
+if sys.version_info >= (3, 11):
+    parse_end_time = datetime.fromisoformat
+else:
+    def parse_end_time(value):
+        return datetime.strptime(value, "%Y-%m-%dT%H:%M:%S%z")
+
 # Load environment variables
 load_dotenv()
 
@@ -12,6 +32,14 @@ PAGE_ID = os.getenv("FACEBOOK_PAGE_ID")
 ACCESS_TOKEN = os.getenv("FACEBOOK_PAGE_ACCESS_TOKEN")
 API_VERSION = os.getenv("FACEBOOK_API_VERSION", "v21.0")
 
+# Dùng chung một session (keep-alive) cho tất cả request tới graph.facebook.com
+session = requests.Session()
+session.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=4,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504])
+))
+
 print("="*60)
 print("FACEBOOK API TOKEN DIAGNOSTICS")
 print("="*60)
@@ -27,10 +55,10 @@ print("\n1. Checking token validity...")
 try:
     print(f"\n   Request URL: {DEBUG_URL}")
     print(f"   Params: {params}")
-    response = requests.get(DEBUG_URL, params=params)
+    response = session.get(DEBUG_URL, params=params)
     print(f"   Response Status: {response.status_code}")
     print(f"   Response: {response.text}")
-    debug_data = response.json()
+    debug_data = json_loads(response.content)
     
     if "data" in debug_data:
         token_info = debug_data["data"]
@@ -56,10 +84,10 @@ params = {
 try:
     print(f"\n   Request URL: {ACCOUNTS_URL}")
     print(f"   Params: {params}")
-    response = requests.get(ACCOUNTS_URL, params=params)
+    response = session.get(ACCOUNTS_URL, params=params)
     print(f"   Response Status: {response.status_code}")
     print(f"   Response: {response.text}")
-    accounts_data = response.json()
+    accounts_data = json_loads(response.content)
     
     if "data" in accounts_data:
         pages = accounts_data["data"]
@@ -128,12 +156,12 @@ params = {
 try:
     print(f"\nRequest URL: {INSIGHTS_URL}")
     print(f"Params: {params}")
-    response = requests.get(INSIGHTS_URL, params=params)
+    response = session.get(INSIGHTS_URL, params=params)
     print(f"Response Status: {response.status_code}")
     print(f"Response: {response.text[:500]}...")  # Print first 500 chars
     response.raise_for_status()
     
-    data = response.json()
+    data = json_loads(response.content)
     
     if "error" in data:
         print(f"\n✗ Facebook API Error: {data['error']}")
@@ -158,28 +186,29 @@ try:
     cursor = conn.cursor()
     
     # Save to PostgreSQL
-    records_saved = 0
+    rows = []
     for metric_block in insights_data:
         metric_name = metric_block["name"]
         report_type = METRICS.get(metric_name, "Unknown")
         
-        print(f"\nProcessing {metric_name} ({report_type}):")
+        values = metric_block.get("values", [])
+        print(f"Processing {metric_name} ({report_type}): {len(values)} values")
         
-        for entry in metric_block.get("values", []):
-            date_value = datetime.fromisoformat(
-                entry["end_time"].replace("Z", "+00:00")
-            ).date()
+        for entry in values:
+            date_value = parse_end_time(entry["end_time"]).date()
             value = entry.get("value", 0)
             
-            cursor.execute("""
-                INSERT INTO facebook_page_insights_daily
-                (metric, report_type, date, value)
-                VALUES (%s, %s, %s, %s)
-                ON CONFLICT (metric, date)
-                DO UPDATE SET value = EXCLUDED.value
-            """, (metric_name, report_type, date_value, value))
-            records_saved += 1
-            print(f"  {date_value}: {value}")
+            rows.append((metric_name, report_type, date_value, value))
+    
+    # Upsert toàn bộ trong một statement thay vì mỗi dòng một round-trip
+    psycopg2.extras.execute_values(cursor, """
+        INSERT INTO facebook_page_insights_daily
+        (metric, report_type, date, value)
+        VALUES %s
+        ON CONFLICT (metric, date)
+        DO UPDATE SET value = EXCLUDED.value
+    """, rows, page_size=500)
+    records_saved = len(rows)
     
     conn.commit()
     cursor.close()
@@ -1,21 +1,53 @@
 from flask import Flask, render_template, jsonify
+from flask.json.provider import JSONProvider
+from flask_caching import Cache
+import orjson
 import psycopg2
 from psycopg2.extras import RealDictCursor
+from psycopg2.pool import ThreadedConnectionPool
 import os
 from dotenv import load_dotenv
-from google.analytics.data_v1beta import BetaAnalyticsDataClient
+from ga_client import get_ga_client
+from db import execute_prepared
 from google.analytics.data_v1beta.types import (
     RunRealtimeReportRequest,
     Dimension,
     Metric
 )
 from datetime import datetime
+from decimal import Decimal
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import csv
+import io
 import json
+import threading
+import time
 
 # Load biến môi trường
 load_dotenv()
 
+class OrjsonProvider(JSONProvider):
+    """JSON provider dùng orjson cho jsonify (nhanh hơn json chuẩn)"""
+
+    @staticmethod
+    def _default(obj):
+        # NUMERIC từ PostgreSQL: giữ nguyên cách Flask mặc định trả về (chuỗi)
+        if isinstance(obj, Decimal):
+            return str(obj)
+        raise TypeError
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self._default).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
+
+# Cache response các API dashboard poll liên tục (dữ liệu chỉ đổi mỗi lần sync)
+cache = Cache(app, config={'CACHE_TYPE': 'SimpleCache', 'CACHE_DEFAULT_TIMEOUT': 60})
 
 # Cấu hình Database
 DB_CONFIG = {
@@ -48,28 +80,74 @@ VIETNAM_CITIES = {
     'Vinh': {'lat': 18.6796, 'lng': 105.6813, 'name': 'Vinh'},
 }
 
-def get_db_connection():
-    """Tạo kết nối tới PostgreSQL"""
-    return psycopg2.connect(**DB_CONFIG)
+# Pool kết nối dùng chung cho các route, tạo lần đầu khi cần
+_db_pool = None
 
-def fetch_ga4_realtime_data():
-    """Lấy dữ liệu realtime từ GA4"""
-    client = BetaAnalyticsDataClient()
+def get_db_pool():
+    """Trả về connection pool PostgreSQL (khởi tạo lazily)"""
+    global _db_pool
+    if _db_pool is None:
+        _db_pool = ThreadedConnectionPool(minconn=2, maxconn=10, **DB_CONFIG)
+    return _db_pool
+
+@contextmanager
+def db_conn():
+    """Mượn một kết nối từ pool và trả lại khi xong"""
+    pool = get_db_pool()
+    conn = pool.getconn()
+    try:
+        yield conn
+    finally:
+        pool.putconn(conn)
+
+def copy_rows(cursor, table, columns, rows):
+    """Ghi nhiều dòng vào bảng bằng COPY FROM STDIN (CSV)"""
+    if not rows:
+        return
     
-    # Request cho Active Users by Location (5 phút)
-    request_5min = RunRealtimeReportRequest(
-        property=f"properties/{GA4_PROPERTY_ID}",
-        dimensions=[Dimension(name="city")],
-        metrics=[Metric(name="activeUsers")],
-        minute_ranges=[{"name": "0-5 minutes ago", "start_minutes_ago": 5}]
+    buf = io.StringIO()
+    csv.writer(buf).writerows(rows)
+    buf.seek(0)
+    
+    cursor.copy_expert(
+        f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)",
+        buf
     )
+
+# Cache kết quả GA4 trong thời gian ngắn để các lần refresh liên tiếp không gọi lại API
+GA4_CACHE_TTL_SECONDS = 60
+_ga4_cache = {'expires_at': 0, 'data': None}
+_ga4_cache_lock = threading.Lock()
+
+# Tên minute range trong report location (dùng để tách rows 5 phút / 30 phút)
+CITY_RANGE_5MIN = "0-5 minutes ago"
+CITY_RANGE_30MIN = "0-29 minutes ago"
+
+def fetch_ga4_realtime_data():
+    """Lấy dữ liệu realtime từ GA4 (cache GA4_CACHE_TTL_SECONDS giây)"""
+    with _ga4_cache_lock:
+        if _ga4_cache['data'] is not None and time.monotonic() < _ga4_cache['expires_at']:
+            return _ga4_cache['data']
+        
+        data = _fetch_ga4_realtime_data()
+        _ga4_cache['data'] = data
+        _ga4_cache['expires_at'] = time.monotonic() + GA4_CACHE_TTL_SECONDS
+        return data
+
+def _fetch_ga4_realtime_data():
+    """Gọi GA4 Realtime API"""
+    client = get_ga_client()
     
-    # Request cho Active Users by Location (29 phút - GA4 Standard limit)
-    request_30min = RunRealtimeReportRequest(
+    # Request cho Active Users by Location: gộp 5 phút và 29 phút (GA4 Standard limit)
+    # vào một report bằng 2 minute_ranges, GA4 thêm tên range vào cuối dimension_values
+    request_city = RunRealtimeReportRequest(
         property=f"properties/{GA4_PROPERTY_ID}",
         dimensions=[Dimension(name="city")],
         metrics=[Metric(name="activeUsers")],
-        minute_ranges=[{"name": "0-29 minutes ago", "start_minutes_ago": 29}]
+        minute_ranges=[
+            {"name": CITY_RANGE_5MIN, "start_minutes_ago": 5},
+            {"name": CITY_RANGE_30MIN, "start_minutes_ago": 29}
+        ]
     )
     
     # Request cho Active Users by Device Category (thay cho Source)
@@ -87,77 +165,80 @@ def fetch_ga4_realtime_data():
         metrics=[Metric(name="screenPageViews")]
     )
     
-    # Thực hiện các request
-    response_5min = client.run_realtime_report(request_5min)
-    response_30min = client.run_realtime_report(request_30min)
-    response_device = client.run_realtime_report(request_device)
-    response_page = client.run_realtime_report(request_page)
-    
-    return {
-        'users_5min': response_5min,
-        'users_30min': response_30min,
-        'by_device': response_device,  # Đổi từ by_source sang by_device
-        'by_page': response_page
+    requests_by_key = {
+        'users_by_city': request_city,
+        'by_device': request_device,  # Đổi từ by_source sang by_device
+        'by_page': request_page
     }
+    
+    # Thực hiện các request song song (client gRPC thread-safe)
+    with ThreadPoolExecutor(max_workers=len(requests_by_key)) as executor:
+        futures = {
+            key: executor.submit(client.run_realtime_report, req)
+            for key, req in requests_by_key.items()
+        }
+        responses = {key: future.result() for key, future in futures.items()}
+    
+    # Tách report location thành 2 dict {city: users} theo minute range
+    users_by_range = {CITY_RANGE_5MIN: {}, CITY_RANGE_30MIN: {}}
+    for row in responses.pop('users_by_city').rows:
+        users_by_range[row.dimension_values[-1].value][row.dimension_values[0].value] = \
+            int(row.metric_values[0].value)
+    responses['users_5min'] = users_by_range[CITY_RANGE_5MIN]
+    responses['users_30min'] = users_by_range[CITY_RANGE_30MIN]
+    return responses
 
 def save_to_database(ga4_data):
     """Lưu dữ liệu GA4 vào PostgreSQL"""
-    conn = get_db_connection()
+    pool = get_db_pool()
+    conn = pool.getconn()
     cursor = conn.cursor()
     
     try:
-        # Xóa dữ liệu cũ
-        cursor.execute("TRUNCATE user_by_location, user_by_source, views_by_page")
+        # Xóa dữ liệu cũ bằng DELETE trong cùng transaction với COPY: khác TRUNCATE
+        # (khóa ACCESS EXCLUSIVE tới khi commit), các API đọc vẫn chạy song song và
+        # thấy snapshot cũ đầy đủ cho tới khi dữ liệu mới được commit
+        cursor.execute("DELETE FROM user_by_location")
+        cursor.execute("DELETE FROM user_by_source")
+        cursor.execute("DELETE FROM views_by_page")
         
         # Lưu dữ liệu location
-        users_5min_dict = {}
-        for row in ga4_data['users_5min'].rows:
-            city = row.dimension_values[0].value
-            users = int(row.metric_values[0].value)
-            users_5min_dict[city] = users
-        
-        users_30min_dict = {}
-        for row in ga4_data['users_30min'].rows:
-            city = row.dimension_values[0].value
-            users = int(row.metric_values[0].value)
-            users_30min_dict[city] = users
+        users_5min_dict = ga4_data['users_5min']
+        users_30min_dict = ga4_data['users_30min']
         
-        # Kết hợp và insert vào DB
-        all_cities = set(users_5min_dict.keys()) | set(users_30min_dict.keys())
-        
-        for city in all_cities:
-            if city in VIETNAM_CITIES:
-                city_info = VIETNAM_CITIES[city]
-                cursor.execute("""
-                    INSERT INTO user_by_location 
-                    (province, city, latitude, longitude, active_users_5min, active_users_30min)
-                    VALUES (%s, %s, %s, %s, %s, %s)
-                """, (
+        # Kết hợp và insert vào DB (chỉ các city có trong VIETNAM_CITIES)
+        location_rows = []
+        for city, city_info in VIETNAM_CITIES.items():
+            users_5min = users_5min_dict.get(city, 0)
+            users_30min = users_30min_dict.get(city, 0)
+            if users_5min or users_30min:
+                location_rows.append((
                     city_info['name'], 
                     city, 
                     city_info['lat'], 
                     city_info['lng'],
-                    users_5min_dict.get(city, 0),
-                    users_30min_dict.get(city, 0)
+                    users_5min,
+                    users_30min
                 ))
+        copy_rows(cursor, 'user_by_location',
+                  ('province', 'city', 'latitude', 'longitude',
+                   'active_users_5min', 'active_users_30min'),
+                  location_rows)
         
         # Lưu dữ liệu device (thay cho source)
-        for row in ga4_data['by_device'].rows:
-            device = row.dimension_values[0].value
-            users = int(row.metric_values[0].value)
-            cursor.execute("""
-                INSERT INTO user_by_source (source, active_users)
-                VALUES (%s, %s)
-            """, (device, users))
+        device_rows = [
+            (row.dimension_values[0].value, int(row.metric_values[0].value))
+            for row in ga4_data['by_device'].rows
+        ]
+        copy_rows(cursor, 'user_by_source', ('source', 'active_users'), device_rows)
         
         # Lưu dữ liệu page views
-        for row in ga4_data['by_page'].rows:
-            page_name = row.dimension_values[0].value
-            views = int(row.metric_values[0].value)
-            cursor.execute("""
-                INSERT INTO views_by_page (page_title, screen_name, views)
-                VALUES (%s, %s, %s)
-            """, (page_name, page_name, views))
+        page_rows = [
+            (page_name, page_name, int(row.metric_values[0].value))
+            for row in ga4_data['by_page'].rows
+            for page_name in (row.dimension_values[0].value,)
+        ]
+        copy_rows(cursor, 'views_by_page', ('page_title', 'screen_name', 'views'), page_rows)
         
         conn.commit()
         print("✓ Data saved successfully!")
@@ -168,7 +249,7 @@ def save_to_database(ga4_data):
         raise
     finally:
         cursor.close()
-        conn.close()
+        pool.putconn(conn)
 
 # Routes
 @app.route('/')
@@ -177,38 +258,42 @@ def index():
     return render_template('index.html')
 
 @app.route('/api/map-data')
+@cache.cached()
 def get_map_data():
     """API trả về dữ liệu cho bản đồ"""
-    conn = get_db_connection()
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
-    
-    cursor.execute("""
-        SELECT province, city, latitude, longitude, 
-               active_users_5min, active_users_30min
-        FROM user_by_location
-        ORDER BY active_users_30min DESC
-    """)
-    
-    data = cursor.fetchall()
-    cursor.close()
-    conn.close()
+    with db_conn() as conn:
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        
+        cursor.execute("""
+            SELECT province, city, latitude, longitude, 
+                   active_users_5min, active_users_30min
+            FROM user_by_location
+            ORDER BY active_users_30min DESC
+        """)
+        
+        data = cursor.fetchall()
+        cursor.close()
     
     return jsonify(data)
 
 @app.route('/api/active-users')
 def get_active_users():
     """API trả về tổng số active users"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute("SELECT active_users_5m FROM realtime_active_users ORDER BY recorded_at DESC LIMIT 1")
-    users_5min = cursor.fetchone()[0] or 0
-    
-    cursor.execute("SELECT active_users_30m FROM realtime_active_users ORDER BY recorded_at DESC LIMIT 1")
-    users_30min = cursor.fetchone()[0] or 0
-    
-    cursor.close()
-    conn.close()
+    with db_conn() as conn:
+        cursor = conn.cursor()
+        
+        # Lấy cả 2 giá trị của bản ghi mới nhất trong một round-trip
+        cursor.execute("""
+            SELECT active_users_5m, active_users_30m
+            FROM realtime_active_users
+            ORDER BY recorded_at DESC
+            LIMIT 1
+        """)
+        row = cursor.fetchone() or (0, 0)
+        users_5min = row[0] or 0
+        users_30min = row[1] or 0
+        
+        cursor.close()
     
     return jsonify({
         'users_5min': users_5min,
@@ -216,40 +301,40 @@ def get_active_users():
     })
 
 @app.route('/api/users-by-source')
+@cache.cached()
 def get_users_by_source():
     """API trả về users theo device/source"""
-    conn = get_db_connection()
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
-    
-    cursor.execute("""
-        SELECT source, active_users
-        FROM user_by_source
-        ORDER BY active_users DESC
-        LIMIT 10
-    """)
-    
-    data = cursor.fetchall()
-    cursor.close()
-    conn.close()
+    with db_conn() as conn:
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        
+        cursor.execute("""
+            SELECT source, active_users
+            FROM user_by_source
+            ORDER BY active_users DESC
+            LIMIT 10
+        """)
+        
+        data = cursor.fetchall()
+        cursor.close()
     
     return jsonify(data)
 
 @app.route('/api/views-by-page')
+@cache.cached()
 def get_views_by_page():
     """API trả về views theo page"""
-    conn = get_db_connection()
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
-    
-    cursor.execute("""
-        SELECT page_title, screen_name, views
-        FROM views_by_page
-        ORDER BY views DESC
-        LIMIT 10
-    """)
-    
-    data = cursor.fetchall()
-    cursor.close()
-    conn.close()
+    with db_conn() as conn:
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        
+        cursor.execute("""
+            SELECT page_title, screen_name, views
+            FROM views_by_page
+            ORDER BY views DESC
+            LIMIT 10
+        """)
+        
+        data = cursor.fetchall()
+        cursor.close()
     
     return jsonify(data)
 
@@ -259,75 +344,57 @@ def refresh_data():
     try:
         ga4_data = fetch_ga4_realtime_data()
         save_to_database(ga4_data)
+        cache.clear()
         return jsonify({'status': 'success', 'message': 'Data refreshed successfully'})
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
 # Facebook API Endpoints
+
+# Lấy cả 4 metrics trong một query (::bigint để JSON trả về số, không phải Decimal)
+FB_DAILY_INSIGHTS_SQL = """
+    SELECT 
+       COALESCE(SUM(value) FILTER (WHERE report_type = 'Views'), 0)::bigint AS fb_views,
+       COALESCE(SUM(value) FILTER (WHERE report_type = 'Viewers'), 0)::bigint AS fb_viewers,
+       COALESCE(SUM(value) FILTER (WHERE report_type = 'Visits'), 0)::bigint AS fb_visits,
+       COALESCE(SUM(value) FILTER (WHERE report_type = 'Follows'), 0)::bigint AS fb_follows
+    FROM facebook_page_insights_daily
+    WHERE date >= CURRENT_DATE - INTERVAL '1 days'
+"""
+
 @app.route('/api/facebook/daily_insights')
 def get_facebook_insights():
     """API trả về tổng hợp metrics Facebook 7 ngày"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
     try:
-        cursor.execute("""
-            SELECT 
-               value
-            FROM facebook_page_insights_daily
-            WHERE date >= CURRENT_DATE - INTERVAL '1 days'
-            AND report_type = 'Views'
-        """)
-        fb_views = cursor.fetchone()[0] or 0
-
-        cursor.execute("""
-            SELECT 
-               value
-            FROM facebook_page_insights_daily
-            WHERE date >= CURRENT_DATE - INTERVAL '1 days'
-            AND report_type = 'Viewers'
-        """)
-        fb_viewers = cursor.fetchone()[0] or 0
-        
-        cursor.execute("""
-            SELECT 
-               value
-            FROM facebook_page_insights_daily
-            WHERE date >= CURRENT_DATE - INTERVAL '1 days'
-            AND report_type = 'Visits'
-        """)
-        fb_visits = cursor.fetchone()[0] or 0
-
-        cursor.execute("""
-            SELECT 
-               value
-            FROM facebook_page_insights_daily
-            WHERE date >= CURRENT_DATE - INTERVAL '1 days'
-            AND report_type = 'Follows'
-        """)
-        fb_follows = cursor.fetchone()[0] or 0
+        with db_conn() as conn:
+            cursor = conn.cursor(cursor_factory=RealDictCursor)
+            
+            execute_prepared(cursor, 'fb_daily_insights', FB_DAILY_INSIGHTS_SQL)
+            insights = cursor.fetchone()
+            cursor.close()
         
-        cursor.close()
-        conn.close()
-        
-        return jsonify({
-            'fb_views': fb_views,
-            'fb_viewers': fb_viewers,
-            'fb_visits': fb_visits,
-            'fb_follows': fb_follows
-        })
+        return jsonify(insights)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+# Chỉ một lần sync Facebook tại một thời điểm: mỗi lần sync giữ một kết nối từ
+# pool của db.py (maxconn 4) suốt lần sync, sync chồng nhau sẽ làm cạn pool
+_fb_refresh_lock = threading.Lock()
+
 @app.route('/api/facebook/refresh')
 def refresh_facebook_data():
-    """API để refresh dữ liệu Facebook"""
+    """API để refresh dữ liệu Facebook (409 nếu đang có lần sync khác chạy)"""
+    if not _fb_refresh_lock.acquire(blocking=False):
+        return jsonify({'status': 'running', 'message': 'Facebook refresh already in progress'}), 409
+    
     try:
         from save_facebook_data import fetch_and_save_all_facebook_data
         fetch_and_save_all_facebook_data()
         return jsonify({'status': 'success', 'message': 'Facebook data refreshed successfully'})
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)}), 500
+    finally:
+        _fb_refresh_lock.release()
 
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
@@ -7,6 +7,7 @@ Chạy liên tục trong background và sync dữ liệu định kỳ
 import time
 import schedule
 import logging
+from logging.handlers import RotatingFileHandler
 import sys
 import os
 from datetime import datetime
@@ -14,39 +15,25 @@ from app import fetch_ga4_realtime_data, save_to_database
 
 # Cấu hình logging
 log_file = 'sync_service.log'
+MAX_LOG_SIZE_MB = 10  # Giới hạn file log 10MB
+LOG_BACKUP_COUNT = 7  # Số file log cũ được giữ lại
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(levelname)s - %(message)s',
     handlers=[
-        logging.FileHandler(log_file, encoding='utf-8'),
+        # Tự xoay vòng khi quá MAX_LOG_SIZE_MB, giữ tối đa LOG_BACKUP_COUNT file cũ
+        RotatingFileHandler(
+            log_file,
+            maxBytes=MAX_LOG_SIZE_MB * 1024 * 1024,
+            backupCount=LOG_BACKUP_COUNT,
+            encoding='utf-8'
+        ),
         logging.StreamHandler(sys.stdout)
     ]
 )
 
 # Cấu hình
 SYNC_INTERVAL_MINUTES = 2  # Sync mỗi 2 phút
-MAX_LOG_SIZE_MB = 10  # Giới hạn file log 10MB
-
-def rotate_log():
-    """Xoay vòng log file nếu quá lớn"""
-    try:
-        if os.path.exists(log_file):
-            size_mb = os.path.getsize(log_file) / (1024 * 1024)
-            if size_mb > MAX_LOG_SIZE_MB:
-                # Backup log cũ
-                backup_name = f"sync_service_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log"
-                os.rename(log_file, backup_name)
-                logging.info(f"Rotated log file to {backup_name}")
-                
-                # Xóa backup cũ hơn 7 ngày
-                for f in os.listdir('.'):
-                    if f.startswith('sync_service_') and f.endswith('.log'):
-                        file_time = os.path.getmtime(f)
-                        if time.time() - file_time > 7 * 86400:  # 7 ngày
-                            os.remove(f)
-                            logging.info(f"Deleted old log: {f}")
-    except Exception as e:
-        logging.error(f"Error rotating log: {e}")
 
 def sync_job():
     """Job sync dữ liệu từ GA4"""
@@ -59,8 +46,8 @@ def sync_job():
         ga4_data = fetch_ga4_realtime_data()
         
         # Đếm số records
-        users_5min = len(ga4_data['users_5min'].rows)
-        users_30min = len(ga4_data['users_30min'].rows)
+        users_5min = len(ga4_data['users_5min'])
+        users_30min = len(ga4_data['users_30min'])
         device_data = len(ga4_data['by_device'].rows)
         page_data = len(ga4_data['by_page'].rows)
         
@@ -76,9 +63,6 @@ def sync_job():
         logging.info(f"✅ Sync completed in {elapsed:.2f} seconds")
         logging.info(f"   Next sync: {datetime.now() + timedelta(minutes=SYNC_INTERVAL_MINUTES)}")
         
-        # Rotate log nếu cần
-        rotate_log()
-        
     except Exception as e:
         logging.error(f"❌ Sync failed: {e}")
         logging.exception("Full error traceback:")
@@ -136,8 +120,13 @@ def main():
     # Main loop
     try:
         while True:
+            # Ngủ đúng tới job kế tiếp thay vì poll mỗi 30 giây
+            delay = schedule.idle_seconds()
+            if delay is None:
+                delay = 3600  # Không còn job nào
+            if delay > 0:
+                time.sleep(delay)
             schedule.run_pending()
-            time.sleep(30)  # Check mỗi 30 giây
     except KeyboardInterrupt:
         logging.info("\n👋 Service stopped by user (Ctrl+C)")
         sys.exit(0)
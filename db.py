@@ -0,0 +1,78 @@
+"""
+Shared PostgreSQL connection pool for the sync scripts
+"""
+
+import os
+import threading
+import weakref
+
+from psycopg2.extensions import make_dsn
+from psycopg2.pool import ThreadedConnectionPool
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def _build_dsn():
+    """
+    Read the DB settings (loading .env from the script directory) and build the
+    connection string. Called once, when the pool is first created, so importing
+    this module does not touch .env. TCP keepalives stop NAT/firewalls from
+    silently dropping idle pooled connections, application_name makes them easy
+    to spot in pg_stat_activity.
+    """
+    from dotenv import load_dotenv
+    load_dotenv(os.path.join(SCRIPT_DIR, ".env"))
+
+    return make_dsn(
+        host=os.getenv("DB_HOST", "localhost"),
+        port=os.getenv("DB_PORT", "5432"),
+        dbname=os.getenv("DB_NAME", "ga4_analytics"),
+        user=os.getenv("DB_USER"),
+        password=os.getenv("DB_PASSWORD"),
+        sslmode=os.getenv("DB_SSLMODE", "prefer"),
+        application_name=os.getenv("DB_APPLICATION_NAME", "vtvtimes_dashboard"),
+        keepalives=1,
+        keepalives_idle=30,
+        keepalives_interval=10,
+        keepalives_count=5
+    )
+
+
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+# Names of statements already PREPAREd on each connection
+_PREPARED = weakref.WeakKeyDictionary()
+
+
+def get_pool():
+    """Create the pool on first use and reuse it for the rest of the process"""
+    global _POOL
+    if _POOL is None:
+        with _POOL_LOCK:
+            if _POOL is None:
+                _POOL = ThreadedConnectionPool(1, 4, _build_dsn())
+    return _POOL
+
+
+def get_connection():
+    """Borrow a connection from the pool; hand it back with release_connection()"""
+    return get_pool().getconn()
+
+
+def release_connection(conn):
+    """Return a connection to the pool (rolls back anything left uncommitted)"""
+    get_pool().putconn(conn)
+
+
+def execute_prepared(cursor, name, sql):
+    """
+    EXECUTE prepared statement `name`, sending PREPARE from `sql` the first time
+    a pooled connection runs it. Prepared statements live as long as the session,
+    so this is safe to call in the middle of a transaction.
+    """
+    prepared = _PREPARED.setdefault(cursor.connection, set())
+    if name not in prepared:
+        cursor.execute(f"PREPARE {name} AS {sql}")
+        prepared.add(name)
+    cursor.execute(f"EXECUTE {name}")
@@ -1,9 +1,26 @@
 import os
+import logging
+import csv
+import io
+import json
 import requests
-import psycopg2
+from db import get_connection, release_connection, execute_prepared
 from datetime import datetime, timedelta, date
-from dotenv import load_dotenv
-from refresh_facebook_token import FacebookTokenManager
+from urllib.parse import urlencode
+from dotenv import load_dotenv, dotenv_values
+from refresh_facebook_token import (
+    FacebookTokenManager, TOKEN_EXPIRY_MARGIN, get_graph_session,
+    cached_token_is_valid, cache_verified_token, forget_token
+)
+
+# orjson parse nhanh hơn json chuẩn; fallback nếu chưa cài
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+log = logging.getLogger(__name__)
 
 # Get the directory where this script is located
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -12,15 +29,93 @@ ENV_FILE = os.path.join(SCRIPT_DIR, ".env")
 # Load environment variables from script directory
 load_dotenv(ENV_FILE)
 
+# Parsed .env values, re-read only when the file's mtime changes
+_ENV_CACHE = {"mtime": None, "values": {}}
+
+def _get_env(key):
+    """
+    Read a value from .env, reparsing the file only after it was modified
+    (e.g. by FacebookTokenManager.update_env_file)
+    """
+    try:
+        mtime = os.stat(ENV_FILE).st_mtime
+    except OSError:
+        return os.getenv(key)
+    
+    if mtime != _ENV_CACHE["mtime"]:
+        values = dotenv_values(ENV_FILE)
+        # Same effect as load_dotenv(override=True) so other readers see fresh values
+        os.environ.update({k: v for k, v in values.items() if v is not None})
+        _ENV_CACHE["mtime"] = mtime
+        _ENV_CACHE["values"] = values
+    
+    value = _ENV_CACHE["values"].get(key)
+    return value if value is not None else os.getenv(key)
+
+def _token_is_usable(token_info):
+    """True if debug_token says the token is valid and not expiring within the margin"""
+    if not token_info or not token_info.get("is_valid"):
+        return False
+    expires_at = token_info.get("expires_at", 0)
+    return expires_at == 0 or expires_at - datetime.now().timestamp() > TOKEN_EXPIRY_MARGIN
+
+def _verify_and_fetch_insights(session, api_version, page_id, token, params):
+    """
+    Check the page token and fetch insights in one Graph API batch request.
+    The batch itself is authorized with the app token and the page token only
+    rides inside the insights item, so an expired page token cannot make Graph
+    reject the whole batch.
+    Returns (token_info, insights_payload); either can be None if its part failed.
+    """
+    app_token = f"{os.getenv('FACEBOOK_APP_ID')}|{os.getenv('FACEBOOK_APP_SECRET')}"
+    insights_query = urlencode({**{k: v for k, v in params.items() if k != "access_token"},
+                                "access_token": token})
+    batch = [
+        {"method": "GET",
+         "relative_url": "debug_token?" + urlencode({"input_token": token})},
+        {"method": "GET", "relative_url": f"{page_id}/insights?{insights_query}"}
+    ]
+    
+    try:
+        response = session.post(
+            f"https://graph.facebook.com/{api_version}/",
+            data={"access_token": app_token, "batch": json.dumps(batch), "include_headers": "false"},
+            timeout=10
+        )
+        response.raise_for_status()
+        items = json_loads(response.content)
+    except (requests.exceptions.RequestException, ValueError) as e:
+        # Batch failed as a whole - caller falls back to get_valid_page_token()
+        log.warning("Batched token check failed (%s) - falling back", e)
+        return None, None
+    
+    if not isinstance(items, list):
+        # Error body such as {"error": {...}} instead of per-item results
+        log.warning("Batched token check returned an error: %s", items)
+        return None, None
+    
+    results = []
+    for item in items:
+        # Items are null when Graph timed out that part of the batch
+        results.append(json_loads(item["body"]) if item and item.get("body") else None)
+    debug_payload, insights_payload = (results + [None, None])[:2]
+    
+    token_info = debug_payload.get("data") if debug_payload else None
+    return token_info, insights_payload
+
 def get_valid_page_token():
     """
     Get a valid page access token, refreshing if necessary
     """
     # First, try to use existing token
-    load_dotenv(ENV_FILE, override=True)  # Always reload to get latest values
-    current_token = os.getenv("FACEBOOK_PAGE_ACCESS_TOKEN")
+    current_token = _get_env("FACEBOOK_PAGE_ACCESS_TOKEN")
     
     if current_token:
+        # Verified recently and not expiring soon - skip /debug_token
+        if cached_token_is_valid(current_token):
+            log.info("✓ Using cached verified page token")
+            return current_token
+        
         manager = FacebookTokenManager(ENV_FILE)
         token_info = manager.verify_token(current_token)
         
@@ -29,167 +124,222 @@ def get_valid_page_token():
             expires_at = token_info.get("expires_at", 0)
             
             if expires_at == 0:  # Never expires
-                print("✓ Using existing valid page token (never expires)")
+                log.info("✓ Using existing valid page token (never expires)")
                 return current_token
             
             # Check if expiring soon (within 1 hour)
             seconds_until_expiry = expires_at - datetime.now().timestamp()
             
-            if seconds_until_expiry > 3600:  # More than 1 hour
+            if seconds_until_expiry > TOKEN_EXPIRY_MARGIN:  # More than 1 hour
                 hours = seconds_until_expiry / 3600
-                print(f"✓ Using existing valid page token (expires in {hours:.1f} hours)")
+                log.info("✓ Using existing valid page token (expires in %.1f hours)", hours)
                 return current_token
             else:
-                print(f"⚠ Page token expires soon ({seconds_until_expiry/60:.0f} minutes) - refreshing...")
+                log.warning("⚠ Page token expires soon (%.0f minutes) - refreshing...", seconds_until_expiry/60)
     
     # Token invalid or expiring soon - refresh
-    print("Refreshing access token...")
+    log.info("Refreshing access token...")
     manager = FacebookTokenManager(ENV_FILE)
     if manager.refresh_tokens():
-        # Reload env after refresh and get the new token
-        load_dotenv(ENV_FILE, override=True)
-        new_token = os.getenv("FACEBOOK_PAGE_ACCESS_TOKEN")
-        
-        print(f"DEBUG: New token from .env: {new_token[:20] if new_token else 'None'}...")
+        # .env was rewritten by the refresh - _get_env picks up the new token
+        new_token = _get_env("FACEBOOK_PAGE_ACCESS_TOKEN")
         
         if new_token:
+            log.debug("New token from .env: length=%d", len(new_token))
+            
             # Verify the new token works
             token_info = manager.verify_token(new_token)
             if token_info and token_info.get("is_valid"):
-                print("✓ Successfully obtained and verified refreshed page token")
+                log.info("✓ Successfully obtained and verified refreshed page token")
                 return new_token
             else:
-                print(f"✗ Refreshed token is invalid: {token_info}")
+                log.error("✗ Refreshed token is invalid: %s", token_info)
                 return None
         else:
-            print("✗ Could not retrieve new token from .env file")
+            log.error("✗ Could not retrieve new token from .env file")
             return None
     
-    print("✗ Token refresh failed")
+    log.error("✗ Token refresh failed")
     return None
 
-def fetch_facebook_insights():
+# Your specific metrics
+METRICS = {
+    "page_views_total": "Visits",
+    "page_media_view": "Views",
+    "page_impressions_unique": "Viewers",
+    "page_daily_follows": "Follows"
+}
+METRIC_PARAM = ",".join(METRICS)
+
+# Merge the staged rows (prepared once per pooled connection; the plan is
+# re-validated automatically when the ON COMMIT DROP temp table is recreated).
+# DISTINCT ON: a (metric, date) repeated in the response must not hit the same
+# target row twice in one ON CONFLICT statement
+UPSERT_STAGE_INSIGHTS_SQL = """
+    INSERT INTO facebook_page_insights_daily
+    (metric, report_type, date, value)
+    SELECT DISTINCT ON (metric, date) metric, report_type, date, value
+    FROM _stage_insights
+    ORDER BY metric, date
+    ON CONFLICT (metric, date)
+    DO UPDATE SET value = EXCLUDED.value
+    WHERE facebook_page_insights_daily.value IS DISTINCT FROM EXCLUDED.value
+"""
+
+def _save_insights(conn, insights_data):
     """
-    Fetch Facebook insights and save to database
+    Upsert insights rows into facebook_page_insights_daily, return the number
+    of rows inserted or changed
     """
-    # Get valid token
-    ACCESS_TOKEN = get_valid_page_token()
+    cursor = conn.cursor()
     
-    if not ACCESS_TOKEN:
-        print("✗ Failed to get valid access token")
-        return False
+    # Resolve each metric's report type once, not once per row
+    report_types = {m["name"]: METRICS.get(m["name"], "Unknown") for m in insights_data}
+    
+    # Save to PostgreSQL: build all rows first, then upsert in one statement
+    rows = [
+        (metric_block["name"],
+         report_types[metric_block["name"]],
+         # end_time is "YYYY-MM-DDTHH:MM:SS+0000": the date is its first 10 chars
+         date.fromisoformat(entry["end_time"][:10]),
+         entry.get("value", 0))
+        for metric_block in insights_data
+        for entry in metric_block.get("values", [])
+    ]
     
+    # COPY into a temp staging table, then upsert from it in one statement.
+    # Only the copied columns (no defaults), so COPY doesn't evaluate the real
+    # table's id sequence / timestamp defaults for every staged row
+    cursor.execute("""
+        CREATE TEMP TABLE _stage_insights ON COMMIT DROP AS
+        SELECT metric, report_type, date, value FROM facebook_page_insights_daily
+        WITH NO DATA
+    """)
+    buf = io.StringIO()
+    csv.writer(buf).writerows(rows)
+    buf.seek(0)
+    cursor.copy_expert(
+        "COPY _stage_insights (metric, report_type, date, value) FROM STDIN WITH (FORMAT csv)",
+        buf
+    )
+    execute_prepared(cursor, "upsert_stage_insights", UPSERT_STAGE_INSIGHTS_SQL)
+    # Rows whose stored value is unchanged are skipped by the WHERE above
+    records_saved = cursor.rowcount
+    if records_saved < len(rows):
+        log.info("  %d of %d rows unchanged - skipped", len(rows) - records_saved, len(rows))
+    
+    conn.commit()
+    cursor.close()
+    return records_saved
+
+def fetch_facebook_insights():
+    """
+    Fetch Facebook insights and save to database
+    """
     # Facebook API config
     PAGE_ID = os.getenv("FACEBOOK_PAGE_ID")
     API_VERSION = os.getenv("FACEBOOK_API_VERSION")
     INSIGHTS_URL = f"https://graph.facebook.com/{API_VERSION}/{PAGE_ID}/insights"
     
-    # Your specific metrics
-    METRICS = {
-        "page_views_total": "Visits",
-        "page_media_view": "Views",
-        "page_impressions_unique": "Viewers",
-        "page_daily_follows": "Follows"
-    }
-    
     # Calculate date range - get yesterday's data
     today = date.today()
     since = today - timedelta(days=2)
     until = today - timedelta(days=1)
     
-    print(f"\nFetching Facebook insights from {since} to {until}")
+    log.info("\nFetching Facebook insights from %s to %s", since, until)
     
     params = {
-        "metric": ",".join(METRICS.keys()),
+        "metric": METRIC_PARAM,
         "period": "day",
         "since": since.isoformat(),
-        "until": until.isoformat(),
-        "access_token": ACCESS_TOKEN
+        "until": until.isoformat()
     }
     
+    # Same Graph API session as FacebookTokenManager: token checks, refresh and
+    # insights requests all reuse one keep-alive connection
+    session = get_graph_session()
+    
     try:
-        response = requests.get(INSIGHTS_URL, params=params)
-        response.raise_for_status()
+        data = None
+        ACCESS_TOKEN = _get_env("FACEBOOK_PAGE_ACCESS_TOKEN")
+        
+        # Token not verified recently: verify it and fetch insights in one batched call
+        if ACCESS_TOKEN and not cached_token_is_valid(ACCESS_TOKEN):
+            token_info, data = _verify_and_fetch_insights(
+                session, API_VERSION, PAGE_ID, ACCESS_TOKEN, params
+            )
+            if _token_is_usable(token_info):
+                log.info("✓ Page token verified (batched with insights request)")
+                cache_verified_token(ACCESS_TOKEN, token_info)
+            else:
+                data = None
         
-        data = response.json()
+        # Cached token, or the batched check failed: get a valid (refreshed) token and fetch
+        if data is None:
+            ACCESS_TOKEN = get_valid_page_token()
+            
+            if not ACCESS_TOKEN:
+                log.error("✗ Failed to get valid access token")
+                return False
+            
+            params['access_token'] = ACCESS_TOKEN
+            response = session.get(INSIGHTS_URL, params=params, timeout=10)
+            response.raise_for_status()
+            
+            data = json_loads(response.content)
         
         if "error" in data:
-            print(f"✗ Facebook API Error: {data['error']}")
+            log.error("✗ Facebook API Error: %s", data['error'])
             
             # If token error, try refreshing once
             if data['error'].get('code') in [190, 102]:
-                print("Token error detected - attempting refresh...")
+                log.info("Token error detected - attempting refresh...")
+                forget_token(ACCESS_TOKEN)
                 ACCESS_TOKEN = get_valid_page_token()
                 if ACCESS_TOKEN:
                     params['access_token'] = ACCESS_TOKEN
-                    response = requests.get(INSIGHTS_URL, params=params)
+                    response = session.get(INSIGHTS_URL, params=params, timeout=10)
                     response.raise_for_status()
-                    data = response.json()
+                    data = json_loads(response.content)
                 else:
                     return False
         
         insights_data = data.get("data", [])
         
         if not insights_data:
-            print("No data returned from Facebook API")
+            log.warning("No data returned from Facebook API")
             return False
         
-        print(f"✓ Fetched {len(insights_data)} metrics from Facebook")
+        log.info("✓ Fetched %s metrics from Facebook", len(insights_data))
         
-        # PostgreSQL connection
-        conn = psycopg2.connect(
-            host=os.getenv("DB_HOST"),
-            port=os.getenv("DB_PORT"),
-            dbname=os.getenv("DB_NAME"),
-            user=os.getenv("DB_USER"),
-            password=os.getenv("DB_PASSWORD")
-        )
-        cursor = conn.cursor()
-        
-        # Save to PostgreSQL
-        records_saved = 0
-        for metric_block in insights_data:
-            metric_name = metric_block["name"]
-            report_type = METRICS.get(metric_name, "Unknown")
-            
-            for entry in metric_block.get("values", []):
-                date_value = datetime.fromisoformat(
-                    entry["end_time"].replace("Z", "+00:00")
-                ).date()
-                value = entry.get("value", 0)
-                
-                cursor.execute("""
-                    INSERT INTO facebook_page_insights_daily
-                    (metric, report_type, date, value)
-                    VALUES (%s, %s, %s, %s)
-                    ON CONFLICT (metric, date)
-                    DO UPDATE SET value = EXCLUDED.value
-                """, (metric_name, report_type, date_value, value))
-                records_saved += 1
-        
-        conn.commit()
-        cursor.close()
-        conn.close()
+        # PostgreSQL connection (from the shared pool)
+        conn = get_connection()
+        try:
+            records_saved = _save_insights(conn, insights_data)
+        finally:
+            release_connection(conn)
         
-        print(f"✓ Successfully saved {records_saved} records to database")
+        log.info("✓ Successfully saved %s records to database", records_saved)
         return True
         
     except requests.exceptions.HTTPError as e:
-        print(f"✗ HTTP Error: {e}")
+        log.error("✗ HTTP Error: %s", e)
         try:
-            error_detail = response.json()
-            print(f"Error details: {error_detail}")
+            error_detail = e.response.json()
+            log.error("Error details: %s", error_detail)
         except:
-            print(f"Response text: {response.text}")
+            log.error("Response text: %s", e.response.text)
         return False
         
     except Exception as e:
-        print(f"✗ Error: {e}")
+        log.error("✗ Error: %s", e)
         import traceback
         traceback.print_exc()
         return False
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    
     print("="*60)
     print("FACEBOOK INSIGHTS SYNC")
     print("="*60)
@@ -4,66 +4,64 @@ from google.analytics.data_v1beta.types import RunRealtimeReportRequest
 
 from config import GA4_PROPERTY_ID
 from ga_client import get_ga_client
-from db import get_connection
+from db import get_connection, release_connection
+
+RANGE_5M = "0-5 minutes ago"
+RANGE_30M = "0-29 minutes ago"
 
 
 def fetch_realtime_active_users():
     client = get_ga_client()
 
-    request_active_users_5m = RunRealtimeReportRequest(
-        property=f"properties/{GA4_PROPERTY_ID}",
-        metrics=[
-            {"name": "activeUsers"}
-        ],
-        minute_ranges=[{"name": "0-5 minutes ago", "start_minutes_ago": 5}]
-    )
-
-    request_active_users_30m = RunRealtimeReportRequest(
+    # One report with both minute ranges; GA4 adds the range name as a dimension value
+    request_active_users = RunRealtimeReportRequest(
         property=f"properties/{GA4_PROPERTY_ID}",
         metrics=[
             {"name": "activeUsers"}
         ],
-        minute_ranges=[{"name": "0-29 minutes ago", "start_minutes_ago": 29}]
+        minute_ranges=[
+            {"name": RANGE_5M, "start_minutes_ago": 5},
+            {"name": RANGE_30M, "start_minutes_ago": 29}
+        ]
     )
 
-
-    response_5m = client.run_realtime_report(
-        request=request_active_users_5m,
+    response = client.run_realtime_report(
+        request=request_active_users,
         timeout=30
     )
 
-    response_30m = client.run_realtime_report(
-        request=request_active_users_30m,
-        timeout=30
-    )
-
-    active_users_5m = 0
-    if response_5m.rows:
-        active_users_5m = int(response_5m.rows[0].metric_values[0].value)
-
-    active_users_30m = 0
-    if response_30m.rows:
-        active_users_30m = int(response_30m.rows[0].metric_values[0].value)
+    users_by_range = {
+        row.dimension_values[-1].value: int(row.metric_values[0].value)
+        for row in response.rows
+    }
+    active_users_5m = users_by_range.get(RANGE_5M, 0)
+    active_users_30m = users_by_range.get(RANGE_30M, 0)
 
     return active_users_5m, active_users_30m
 
 def save_to_db(active_users_5m: int, active_users_30m: int):
     conn = get_connection()
-    cur = conn.cursor()
-
-    cur.execute("TRUNCATE TABLE realtime_active_users")
-    cur.execute("""
-         INSERT INTO realtime_active_users (active_users_5m, recorded_at, active_users_30m)
-         VALUES (%s, %s, %s)
-     """, (
-         active_users_5m,
-         datetime.now(timezone.utc),
-         active_users_30m
-     ))
-
-    conn.commit()
-    cur.close()
-    conn.close()
+    try:
+        cur = conn.cursor()
+
+        # Single-row table keyed on id = 1 (migrations/004): update in place
+        cur.execute("""
+             INSERT INTO realtime_active_users (id, active_users_5m, recorded_at, active_users_30m)
+             VALUES (1, %s, %s, %s)
+             ON CONFLICT (id) DO UPDATE SET
+                 active_users_5m = EXCLUDED.active_users_5m,
+                 recorded_at = EXCLUDED.recorded_at,
+                 active_users_30m = EXCLUDED.active_users_30m
+         """, (
+             active_users_5m,
+             datetime.now(timezone.utc),
+             active_users_30m
+         ))
+
+        conn.commit()
+        cur.close()
+    finally:
+        release_connection(conn)
 
 
 if __name__ == "__main__":
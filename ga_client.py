@@ -0,0 +1,20 @@
+"""
+Shared GA4 Data API client (one gRPC channel per process)
+"""
+
+import threading
+
+from google.analytics.data_v1beta import BetaAnalyticsDataClient
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_ga_client():
+    """Create the client on first call and return the same instance afterwards"""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = BetaAnalyticsDataClient()
+    return _client
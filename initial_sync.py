@@ -6,6 +6,7 @@ Chạy file này trước khi khởi động Flask app
 
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -43,6 +44,38 @@ if missing_vars:
 
 print("   ✅ All environment variables configured!")
 
+# Test query GA4 chạy nền song song với Bước 2 (cả hai chỉ chờ network),
+# kết quả được in ra ở Bước 3
+def probe_ga4():
+    """Gọi thử GA4 Realtime API, trả về (property_id, response)"""
+    from google.analytics.data_v1beta.types import RunRealtimeReportRequest, Dimension, Metric
+    from ga_client import get_ga_client
+    
+    # Thiết lập credentials
+    credentials_path = os.getenv('GOOGLE_APPLICATION_CREDENTIALS')
+    
+    if not os.path.exists(credentials_path):
+        raise FileNotFoundError(credentials_path)
+    
+    os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = credentials_path
+    
+    # Test connection (cùng client mà app.fetch_ga4_realtime_data dùng ở Bước 4)
+    client = get_ga_client()
+    property_id = os.getenv('GA4_PROPERTY_ID')
+    
+    # Thử lấy dữ liệu đơn giản
+    request = RunRealtimeReportRequest(
+        property=f"properties/{property_id}",
+        dimensions=[Dimension(name="city")],
+        metrics=[Metric(name="activeUsers")],
+        limit=1
+    )
+    
+    return property_id, client.run_realtime_report(request)
+
+probe_executor = ThreadPoolExecutor(max_workers=1)
+ga4_probe = probe_executor.submit(probe_ga4)
+
 # Bước 2: Kiểm tra kết nối Database
 print("\n📋 Step 2: Testing PostgreSQL connection...")
 
@@ -97,38 +130,14 @@ except Exception as e:
 print("\n📋 Step 3: Testing Google Analytics API connection...")
 
 try:
-    from google.analytics.data_v1beta import BetaAnalyticsDataClient
-    from google.analytics.data_v1beta.types import RunRealtimeReportRequest, Dimension, Metric
-    
-    # Thiết lập credentials
-    credentials_path = os.getenv('GOOGLE_APPLICATION_CREDENTIALS')
-    
-    if not os.path.exists(credentials_path):
-        print(f"   ❌ Credentials file not found: {credentials_path}")
-        sys.exit(1)
-    
-    os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = credentials_path
-    
-    # Test connection
-    client = BetaAnalyticsDataClient()
-    property_id = os.getenv('GA4_PROPERTY_ID')
-    
-    # Thử lấy dữ liệu đơn giản
-    request = RunRealtimeReportRequest(
-        property=f"properties/{property_id}",
-        dimensions=[Dimension(name="city")],
-        metrics=[Metric(name="activeUsers")],
-        limit=1
-    )
-    
-    response = client.run_realtime_report(request)
+    property_id, response = ga4_probe.result()
     print(f"   ✅ Connected to Google Analytics!")
     print(f"   📊 Property ID: {property_id}")
     print(f"   📊 Test query returned: {len(response.rows)} row(s)")
     
-except FileNotFoundError:
+except FileNotFoundError as e:
     print(f"   ❌ Credentials file not found!")
-    print(f"   Path: {credentials_path}")
+    print(f"   Path: {e}")
     sys.exit(1)
 except Exception as e:
     print(f"   ❌ Google Analytics API connection failed!")
@@ -138,6 +147,8 @@ except Exception as e:
     print("   - Wrong GA4_PROPERTY_ID")
     print("   - Service account not granted access in GA4")
     sys.exit(1)
+finally:
+    probe_executor.shutdown(wait=False)
 
 # Bước 4: Fetch dữ liệu từ GA4
 print("\n📋 Step 4: Fetching data from Google Analytics...")
@@ -149,8 +160,8 @@ try:
     ga4_data = fetch_ga4_realtime_data()
     
     # Kiểm tra dữ liệu đã lấy được
-    users_5min_count = len(ga4_data['users_5min'].rows)
-    users_30min_count = len(ga4_data['users_30min'].rows)
+    users_5min_count = len(ga4_data['users_5min'])
+    users_30min_count = len(ga4_data['users_30min'])
     source_count = len(ga4_data['by_device'].rows)
     page_count = len(ga4_data['by_page'].rows)
     
@@ -175,38 +186,30 @@ except Exception as e:
 print("\n📋 Step 5: Saving data to PostgreSQL...")
 
 try:
-    from app import save_to_database
+    from app import save_to_database, db_conn
     
     print("   ⏳ Writing data to database...")
     save_to_database(ga4_data)
     print("   ✅ Data saved successfully!")
     
-    # Verify data đã được lưu
-    conn = psycopg2.connect(
-        host=os.getenv('DB_HOST'),
-        port=os.getenv('DB_PORT'),
-        database=os.getenv('DB_NAME'),
-        user=os.getenv('DB_USER'),
-        password=os.getenv('DB_PASSWORD')
-    )
-    cursor = conn.cursor()
-    
-    cursor.execute("SELECT COUNT(*) FROM user_by_location")
-    location_count = cursor.fetchone()[0]
+    # Verify data đã được lưu (dùng lại connection pool của app, không mở kết nối mới)
+    with db_conn() as conn:
+        cursor = conn.cursor()
     
-    cursor.execute("SELECT COUNT(*) FROM user_by_source")
-    source_count = cursor.fetchone()[0]
+        # Đếm cả 3 bảng trong một query
+        cursor.execute("""
+            SELECT (SELECT COUNT(*) FROM user_by_location),
+                   (SELECT COUNT(*) FROM user_by_source),
+                   (SELECT COUNT(*) FROM views_by_page)
+        """)
+        location_count, source_count, page_count = cursor.fetchone()
     
-    cursor.execute("SELECT COUNT(*) FROM views_by_page")
-    page_count = cursor.fetchone()[0]
+        print(f"\n   📊 Database verification:")
+        print(f"      📍 user_by_location: {location_count} rows")
+        print(f"      📊 user_by_source: {source_count} rows")
+        print(f"      📄 views_by_page: {page_count} rows")
     
-    print(f"\n   📊 Database verification:")
-    print(f"      📍 user_by_location: {location_count} rows")
-    print(f"      📊 user_by_source: {source_count} rows")
-    print(f"      📄 views_by_page: {page_count} rows")
-    
-    cursor.close()
-    conn.close()
+        cursor.close()
     
 except Exception as e:
     print(f"   ❌ Failed to save data to database!")
@@ -0,0 +1,22 @@
+-- Index cho các API đọc của dashboard (ORDER BY ... DESC LIMIT N)
+-- Chạy ngoài transaction (CREATE INDEX CONCURRENTLY không chạy được trong BEGIN):
+--   psql -d ga4_analytics -f migrations/001_read_path_indexes.sql
+
+-- /api/users-by-source
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_user_by_source_active_users
+    ON user_by_source (active_users DESC)
+    INCLUDE (source);
+
+-- /api/views-by-page
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_views_by_page_views
+    ON views_by_page (views DESC)
+    INCLUDE (page_title, screen_name);
+
+-- /api/map-data
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_user_by_location_active_users_30min
+    ON user_by_location (active_users_30min DESC)
+    INCLUDE (province, city, latitude, longitude, active_users_5min);
+
+-- /api/facebook/top-posts
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_facebook_post_insights_total_engagement
+    ON facebook_post_insights ((post_reactions + post_comments + post_shares) DESC);
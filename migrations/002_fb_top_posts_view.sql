@@ -0,0 +1,26 @@
+-- Materialized view cho /api/facebook/top-posts
+-- Được refresh sau mỗi lần /api/facebook/refresh (REFRESH ... CONCURRENTLY cần unique index)
+--   psql -d ga4_analytics -f migrations/002_fb_top_posts_view.sql
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS fb_top_posts AS
+SELECT
+    post_id,
+    post_message,
+    post_type,
+    created_time,
+    post_impressions,
+    post_engaged_users,
+    post_reactions,
+    post_comments,
+    post_shares,
+    (post_reactions + post_comments + post_shares) AS total_engagement
+FROM facebook_post_insights
+WHERE created_time >= now() - INTERVAL '7 days'
+ORDER BY total_engagement DESC
+LIMIT 50;
+
+CREATE UNIQUE INDEX IF NOT EXISTS ux_fb_top_posts_post_id
+    ON fb_top_posts (post_id);
+
+CREATE INDEX IF NOT EXISTS ix_fb_top_posts_total_engagement
+    ON fb_top_posts (total_engagement DESC);
@@ -0,0 +1,7 @@
+-- Index cho /api/facebook/daily_insights (lọc theo report_type và date >= CURRENT_DATE - 1)
+-- Index user_by_location(active_users_30min DESC) cho /api/map-data đã có trong 001_read_path_indexes.sql
+--   psql -d ga4_analytics -f migrations/003_facebook_daily_insights_index.sql
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_fbpid_rt_date
+    ON facebook_page_insights_daily (report_type, date DESC)
+    INCLUDE (value);
@@ -0,0 +1,39 @@
+-- realtime_active_users chỉ giữ một bản ghi mới nhất: khóa cố định id = 1 để
+-- fetch_realtime_users.py UPSERT thay cho TRUNCATE + INSERT
+--   psql -d ga4_analytics -f migrations/004_realtime_active_users_singleton.sql
+
+BEGIN;
+
+-- Chỉ giữ lại bản ghi mới nhất
+DELETE FROM realtime_active_users
+WHERE ctid <> (
+    SELECT ctid FROM realtime_active_users
+    ORDER BY recorded_at DESC
+    LIMIT 1
+);
+
+DO $$
+BEGIN
+    IF NOT EXISTS (
+        SELECT 1 FROM information_schema.columns
+        WHERE table_name = 'realtime_active_users' AND column_name = 'id'
+    ) THEN
+        ALTER TABLE realtime_active_users ADD COLUMN id INT;
+    END IF;
+END $$;
+
+UPDATE realtime_active_users SET id = 1;
+ALTER TABLE realtime_active_users ALTER COLUMN id SET DEFAULT 1;
+ALTER TABLE realtime_active_users ALTER COLUMN id SET NOT NULL;
+
+DO $$
+BEGIN
+    IF NOT EXISTS (
+        SELECT 1 FROM pg_constraint
+        WHERE conrelid = 'realtime_active_users'::regclass AND contype = 'p'
+    ) THEN
+        ALTER TABLE realtime_active_users ADD PRIMARY KEY (id);
+    END IF;
+END $$;
+
+COMMIT;
@@ -0,0 +1,20 @@
+-- Index cho các query cửa sổ 7 ngày của save_facebook_data.py
+-- Chạy ngoài transaction (CREATE INDEX CONCURRENTLY không chạy được trong BEGIN):
+--   psql -d ga4_analytics -f migrations/005_facebook_sync_window_indexes.sql
+--
+-- facebook_page_stats không cần thêm index: unique index của stat_date (dùng cho
+-- ON CONFLICT) đã phục vụ được ORDER BY stat_date DESC LIMIT 2
+
+-- calculate_and_save_summary_metrics + get_sync_summary: index-only scan 7 ngày
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_facebook_page_insights_insight_date
+    ON facebook_page_insights (insight_date DESC)
+    INCLUDE (page_views, page_impressions, page_impressions_unique, page_post_engagements);
+
+-- get_sync_summary: đếm posts 7 ngày gần nhất
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_facebook_post_insights_created_time
+    ON facebook_post_insights (created_time DESC);
+
+-- get_sync_summary: count/sum trên facebook_metrics_summary
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_facebook_metrics_summary_metric_date
+    ON facebook_metrics_summary (metric_date DESC)
+    INCLUDE (total_views, total_viewers, total_engagement, engagement_rate);
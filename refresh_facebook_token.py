@@ -1,7 +1,17 @@
 import os
+import logging
+import hashlib
+import json
+import stat
+import tempfile
+import time
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from datetime import datetime
-from dotenv import load_dotenv, set_key
+from dotenv import load_dotenv, dotenv_values
+
+log = logging.getLogger(__name__)
 
 # Get the directory where this script is located
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -10,6 +20,96 @@ ENV_FILE = os.path.join(SCRIPT_DIR, ".env")
 # Load environment variables from script directory
 load_dotenv(ENV_FILE)
 
+# (connect, read) timeout in seconds for Graph API calls
+REQUEST_TIMEOUT = (3.05, 27)
+
+# One Graph API session per process, shared by every FacebookTokenManager and the
+# insights fetch so debug_token / accounts / insights ride the same TLS connection
+_GRAPH_SESSION = None
+
+def get_graph_session():
+    """
+    requests.Session for graph.facebook.com, retrying transient errors
+    (rate limit / 5xx / connection reset) with backoff
+    """
+    global _GRAPH_SESSION
+    if _GRAPH_SESSION is None:
+        session = requests.Session()
+        session.mount("https://", HTTPAdapter(max_retries=Retry(
+            total=3,
+            backoff_factor=0.5,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=["GET", "POST"],
+            raise_on_status=False
+        )))
+        _GRAPH_SESSION = session
+    return _GRAPH_SESSION
+
+# Cache of debug_token results (sha256 of token -> expires_at, type, verified_at),
+# persisted next to .env so repeated cron runs can skip the /debug_token round-trip
+TOKEN_CACHE_FILE = os.path.join(SCRIPT_DIR, ".facebook_token_cache.json")
+TOKEN_EXPIRY_MARGIN = 3600        # treat tokens expiring within 1 hour as needing a check
+TOKEN_RECHECK_SECONDS = 6 * 3600  # re-verify never-expiring tokens every 6 hours
+_TOKEN_CACHE = {}
+
+# Skip refresh_tokens if it last succeeded within this window (timestamp kept in .env)
+LAST_REFRESH_KEY = "FACEBOOK_LAST_REFRESH_AT"
+REFRESH_INTERVAL = 3600
+MIN_PAGE_TOKEN_LIFETIME = 24 * 3600
+
+def _token_key(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+def _load_token_cache():
+    if not _TOKEN_CACHE:
+        try:
+            with open(TOKEN_CACHE_FILE) as f:
+                _TOKEN_CACHE.update(json.load(f))
+        except (OSError, ValueError):
+            pass
+    return _TOKEN_CACHE
+
+def _save_token_cache():
+    try:
+        with open(TOKEN_CACHE_FILE, "w") as f:
+            json.dump(_TOKEN_CACHE, f)
+    except OSError as e:
+        log.warning("⚠ Could not write token cache: %s", e)
+
+def _entry_is_fresh(entry, now):
+    if entry["expires_at"] == 0:
+        return now - entry["verified_at"] < TOKEN_RECHECK_SECONDS
+    return entry["expires_at"] - now > TOKEN_EXPIRY_MARGIN
+
+def cached_token_info(token):
+    """
+    debug_token-style details for a token verified earlier, or None when the
+    cache has no entry or the token is close to expiry
+    """
+    entry = _load_token_cache().get(_token_key(token))
+    if not entry or not _entry_is_fresh(entry, time.time()):
+        return None
+    return {"is_valid": True, "expires_at": entry["expires_at"], "type": entry.get("type")}
+
+def cached_token_is_valid(token):
+    return cached_token_info(token) is not None
+
+def cache_verified_token(token, token_info):
+    """Remember a valid debug_token result; stale entries are dropped on write"""
+    now = time.time()
+    for key in [k for k, e in _load_token_cache().items() if not _entry_is_fresh(e, now)]:
+        del _TOKEN_CACHE[key]
+    _TOKEN_CACHE[_token_key(token)] = {
+        "expires_at": token_info.get("expires_at", 0),
+        "type": token_info.get("type"),
+        "verified_at": now
+    }
+    _save_token_cache()
+
+def forget_token(token):
+    if _load_token_cache().pop(_token_key(token), None) is not None:
+        _save_token_cache()
+
 class FacebookTokenManager:
     def __init__(self, env_file=None):
         self.app_id = os.getenv("FACEBOOK_APP_ID")
@@ -18,10 +118,19 @@ class FacebookTokenManager:
         self.page_id = os.getenv("FACEBOOK_PAGE_ID")
         self.api_version = os.getenv("FACEBOOK_API_VERSION")
         
+        # App access token for /debug_token, built once
+        self._app_access_token = f"{self.app_id}|{self.app_secret}"
+        
+        # Reuse one keep-alive connection to graph.facebook.com for all calls
+        self.session = get_graph_session()
+        
         # Use the .env file in the script directory
         self.env_file = env_file if env_file else ENV_FILE
         
-        print(f"Using .env file: {os.path.abspath(self.env_file)}")
+        # .env updates queued by update_env_file()
+        self._pending_env = {}
+        
+        log.info("Using .env file: %s", os.path.abspath(self.env_file))
     
     def exchange_for_long_lived_token(self, short_lived_token):
         """
@@ -35,18 +144,18 @@ class FacebookTokenManager:
             "fb_exchange_token": short_lived_token
         }
         
-        print("Exchanging for long-lived user token...")
-        response = requests.get(url, params=params)
+        log.info("Exchanging for long-lived user token...")
+        response = self.session.get(url, params=params, timeout=REQUEST_TIMEOUT)
         
         if response.status_code == 200:
             data = response.json()
             long_lived_token = data.get("access_token")
             expires_in = data.get("expires_in", 0)
             
-            print(f"✓ Long-lived token obtained (expires in {expires_in} seconds / ~{expires_in//86400} days)")
+            log.info("✓ Long-lived token obtained (expires in %s seconds / ~%d days)", expires_in, expires_in//86400)
             return long_lived_token
         else:
-            print(f"✗ Error: {response.text}")
+            log.error("✗ Error: %s", response.text)
             return None
     
     def get_page_access_token(self, user_token):
@@ -57,94 +166,184 @@ class FacebookTokenManager:
         url = f"https://graph.facebook.com/{self.api_version}/me/accounts"
         params = {"access_token": user_token}
         
-        print("\nGetting Page Access Token...")
-        response = requests.get(url, params=params)
+        log.info("\nGetting Page Access Token...")
+        response = self.session.get(url, params=params, timeout=REQUEST_TIMEOUT)
         
         if response.status_code == 200:
             data = response.json()
             pages = data.get("data", [])
             
             for page in pages:
-                print(f"  Found page: {page['name']} (ID: {page['id']})")
+                log.info("  Found page: %s (ID: %s)", page['name'], page['id'])
                 if page['id'] == self.page_id:
                     page_token = page['access_token']
-                    print(f"  ✓ Page Access Token obtained for {page['name']}")
+                    log.info("  ✓ Page Access Token obtained for %s", page['name'])
                     return page_token
             
-            print(f"✗ Page ID {self.page_id} not found")
+            log.error("✗ Page ID %s not found", self.page_id)
             return None
         else:
-            print(f"✗ Error: {response.text}")
+            log.error("✗ Error: %s", response.text)
             return None
     
     def verify_token(self, token):
         """
-        Verify token and get its details
+        Verify token and get its details.
+        Answered locally from the token cache while a previously verified
+        token is not close to expiry; otherwise calls /debug_token.
         """
+        cached = cached_token_info(token)
+        if cached:
+            return cached
+        
         url = f"https://graph.facebook.com/{self.api_version}/debug_token"
         params = {
             "input_token": token,
-            "access_token": f"{self.app_id}|{self.app_secret}"
+            "access_token": self._app_access_token
         }
         
-        response = requests.get(url, params=params)
+        response = self.session.get(url, params=params, timeout=REQUEST_TIMEOUT)
         
         if response.status_code == 200:
             data = response.json().get("data", {})
+            if data.get("is_valid"):
+                cache_verified_token(token, data)
             return data
         return None
     
     def update_env_file(self, key, value):
         """
-        Update .env file with new token
+        Queue a .env update; written together with the others by flush_env_file()
+        """
+        self._pending_env[key] = value
+        os.environ[key] = value
+    
+    def flush_env_file(self):
+        """
+        Write all queued .env updates in one read-modify-write of the file.
+        Queued values are kept until the write succeeds; on failure the error
+        is logged and re-raised so refresh_tokens() fails instead of silently
+        dropping a refreshed token.
         """
+        if not self._pending_env:
+            return
+        
+        pending = dict(self._pending_env)
         try:
-            set_key(self.env_file, key, value)
-            print(f"✓ Updated {key} in {self.env_file}")
+            try:
+                with open(self.env_file) as f:
+                    lines = f.read().splitlines()
+                # Keep the existing permissions (.env holds tokens and DB_PASSWORD)
+                mode = stat.S_IMODE(os.stat(self.env_file).st_mode)
+            except FileNotFoundError:
+                lines = []
+                mode = 0o600
             
-            # Verify it was written
-            load_dotenv(self.env_file, override=True)
-            saved_value = os.getenv(key)
-            if saved_value == value:
-                print(f"  ✓ Verified: {key} saved correctly")
-            else:
-                print(f"  ⚠ Warning: {key} may not have saved correctly")
+            remaining = dict(pending)
+            for i, line in enumerate(lines):
+                key = line.split("=", 1)[0].strip()
+                if key.startswith("export "):
+                    key = key[len("export "):].strip()
+                if key in remaining:
+                    lines[i] = f"{key}='{remaining.pop(key)}'"
+            lines.extend(f"{key}='{value}'" for key, value in remaining.items())
+            
+            # Private temp file next to .env (unique name, so concurrent refreshes
+            # don't clobber each other), then an atomic rename over it
+            fd, tmp_file = tempfile.mkstemp(
+                dir=os.path.dirname(os.path.abspath(self.env_file)), prefix=".env.", suffix=".tmp"
+            )
+            try:
+                with os.fdopen(fd, "w") as f:
+                    f.write("\n".join(lines) + "\n")
+                os.chmod(tmp_file, mode)
+                os.replace(tmp_file, self.env_file)
+            except BaseException:
+                os.unlink(tmp_file)
+                raise
         except Exception as e:
-            print(f"✗ Error updating {key}: {e}")
+            log.error("✗ Error updating %s: %s", ", ".join(pending), e)
+            raise
+        
+        for key in pending:
+            if self._pending_env.get(key) == pending[key]:
+                del self._pending_env[key]
+        
+        # Verify it was written
+        saved = dotenv_values(self.env_file)
+        for key, value in pending.items():
+            log.info("✓ Updated %s in %s", key, self.env_file)
+            if saved.get(key) == value:
+                log.info("  ✓ Verified: %s saved correctly", key)
+            else:
+                log.warning("  ⚠ Warning: %s may not have saved correctly", key)
+    
+    def recently_refreshed(self):
+        """
+        True if the last successful refresh was within REFRESH_INTERVAL and the
+        current page token is known (from the token cache) to last > 24 hours
+        """
+        try:
+            last_refresh = int(os.getenv(LAST_REFRESH_KEY, "0"))
+        except ValueError:
+            return False
+        
+        now = time.time()
+        if now - last_refresh >= REFRESH_INTERVAL:
+            return False
+        
+        page_token = os.getenv("FACEBOOK_PAGE_ACCESS_TOKEN")
+        token_info = cached_token_info(page_token) if page_token else None
+        if not token_info:
+            return False
+        
+        expires_at = token_info["expires_at"]
+        return expires_at == 0 or expires_at - now > MIN_PAGE_TOKEN_LIFETIME
     
     def refresh_tokens(self):
         """
         Main method to refresh all tokens
         """
-        print("="*60)
-        print("FACEBOOK TOKEN REFRESH")
-        print("="*60)
+        try:
+            return self._refresh_tokens()
+        finally:
+            # One .env write for every token updated during this refresh
+            self.flush_env_file()
+    
+    def _refresh_tokens(self):
+        log.info("=" * 60)
+        log.info("FACEBOOK TOKEN REFRESH")
+        log.info("=" * 60)
+        
+        if self.recently_refreshed():
+            log.info("✓ Tokens refreshed less than an hour ago and page token still valid - skipping")
+            return True
         
         # Step 1: Exchange short-lived for long-lived user token
         if self.user_token:
             token_info = self.verify_token(self.user_token)
             
             if token_info and token_info.get("is_valid"):
-                print(f"\nCurrent user token is valid")
-                print(f"  Type: {token_info.get('type')}")
-                print(f"  Expires: {datetime.fromtimestamp(token_info.get('expires_at', 0))}")
+                log.info("\nCurrent user token is valid")
+                log.info("  Type: %s", token_info.get('type'))
+                log.info("  Expires: %s", datetime.fromtimestamp(token_info.get('expires_at', 0)))
                 
                 # Check if token expires soon (less than 7 days)
                 expires_at = token_info.get("expires_at", 0)
                 days_until_expiry = (expires_at - datetime.now().timestamp()) / 86400
                 
                 if days_until_expiry < 7:
-                    print(f"  ⚠ Token expires in {days_until_expiry:.1f} days - refreshing...")
+                    log.warning("  ⚠ Token expires in %.1f days - refreshing...", days_until_expiry)
                     long_lived_token = self.exchange_for_long_lived_token(self.user_token)
                     if long_lived_token:
                         self.user_token = long_lived_token
                         self.update_env_file("FACEBOOK_USER_ACCESS_TOKEN", long_lived_token)
                     else:
-                        print(f"  ⚠ Token exchange failed, but continuing with current token...")
+                        log.warning("  ⚠ Token exchange failed, but continuing with current token...")
                 else:
-                    print(f"  ✓ Token is still valid for {days_until_expiry:.1f} days")
+                    log.info("  ✓ Token is still valid for %.1f days", days_until_expiry)
             else:
-                print("\n✗ User token is invalid - please generate a new one from Graph API Explorer")
+                log.error("\n✗ User token is invalid - please generate a new one from Graph API Explorer")
                 return False
         
         # Step 2: Get Page Access Token
@@ -156,25 +355,29 @@ class FacebookTokenManager:
             # Verify the page token
             page_token_info = self.verify_token(page_token)
             if page_token_info:
-                print(f"\nPage token details:")
-                print(f"  Type: {page_token_info.get('type')}")
-                print(f"  Valid: {page_token_info.get('is_valid')}")
+                log.info("\nPage token details:")
+                log.info("  Type: %s", page_token_info.get('type'))
+                log.info("  Valid: %s", page_token_info.get('is_valid'))
                 
                 expires_at = page_token_info.get("expires_at", 0)
                 if expires_at == 0:
-                    print(f"  Expires: Never (as long as user token is valid)")
+                    log.info("  Expires: Never (as long as user token is valid)")
                 else:
-                    print(f"  Expires: {datetime.fromtimestamp(expires_at)}")
+                    log.info("  Expires: %s", datetime.fromtimestamp(expires_at))
             
-            print("\n" + "="*60)
-            print("✓ TOKEN REFRESH COMPLETE")
-            print("="*60)
+            self.update_env_file(LAST_REFRESH_KEY, str(int(time.time())))
+            
+            log.info("\n" + "=" * 60)
+            log.info("✓ TOKEN REFRESH COMPLETE")
+            log.info("=" * 60)
             return True
         else:
-            print("\n✗ Failed to get Page Access Token")
+            log.error("\n✗ Failed to get Page Access Token")
             return False
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    
     manager = FacebookTokenManager()
     success = manager.refresh_tokens()
     
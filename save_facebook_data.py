@@ -4,33 +4,47 @@ Lưu dữ liệu Facebook vào PostgreSQL Database
 Updated: Loại bỏ hoàn toàn deprecated metrics
 """
 
-import psycopg2
 from psycopg2.extras import execute_values
-import os
-from dotenv import load_dotenv
+import csv
+import io
+from concurrent.futures import ThreadPoolExecutor
+from operator import itemgetter
 from datetime import datetime
 from facebook_api import (
     FacebookAPI, 
     format_insights_for_database, 
     format_posts_for_database
 )
+from db import execute_prepared, get_connection, release_connection
 
-load_dotenv()
+def get_db_connection():
+    """Mượn kết nối từ pool dùng chung (db.py), trả lại bằng release_db_connection()"""
+    return get_connection()
 
-# Database config
-DB_CONFIG = {
-    'host': os.getenv('DB_HOST', 'localhost'),
-    'port': os.getenv('DB_PORT', '5432'),
-    'database': os.getenv('DB_NAME', 'ga4_analytics'),
-    'user': os.getenv('DB_USER'),
-    'password': os.getenv('DB_PASSWORD')
-}
+def release_db_connection(conn):
+    """Trả kết nối về pool (phần chưa commit sẽ bị rollback)"""
+    release_connection(conn)
 
-def get_db_connection():
-    """Tạo kết nối database"""
-    return psycopg2.connect(**DB_CONFIG)
+# Upsert nhiều ngày page insights cùng lúc (execute_values điền VALUES %s)
+UPSERT_PAGE_INSIGHTS_SQL = """
+    INSERT INTO facebook_page_insights 
+    (insight_date, page_views, page_impressions, 
+     page_impressions_unique, page_post_engagements, 
+     page_posts_impressions, page_reactions, page_video_views)
+    VALUES %s
+    ON CONFLICT (insight_date) 
+    DO UPDATE SET
+        page_views = EXCLUDED.page_views,
+        page_impressions = EXCLUDED.page_impressions,
+        page_impressions_unique = EXCLUDED.page_impressions_unique,
+        page_post_engagements = EXCLUDED.page_post_engagements,
+        page_posts_impressions = EXCLUDED.page_posts_impressions,
+        page_reactions = EXCLUDED.page_reactions,
+        page_video_views = EXCLUDED.page_video_views,
+        updated_at = CURRENT_TIMESTAMP
+"""
 
-def save_page_insights(insights_data):
+def save_page_insights(insights_data, conn=None):
     """
     Lưu Page Insights vào database
     Chỉ lưu active metrics, không lưu deprecated metrics:
@@ -41,196 +55,263 @@ def save_page_insights(insights_data):
     
     Args:
         insights_data: List of dicts với page insights theo ngày
+        conn: Kết nối dùng chung (None = tự mở kết nối riêng)
     """
     if not insights_data:
         print("⚠️  No page insights data to save")
         return
     
-    conn = get_db_connection()
+    # Chỉ tự mở (và commit/đóng) kết nối khi caller không truyền vào
+    owns_conn = conn is None
+    if owns_conn:
+        conn = get_db_connection()
     cursor = conn.cursor()
     
     try:
-        for data in insights_data:
-            # Chỉ lưu active metrics
-            cursor.execute("""
-                INSERT INTO facebook_page_insights 
-                (insight_date, page_views, page_impressions, 
-                 page_impressions_unique, page_post_engagements, 
-                 page_posts_impressions, page_reactions, page_video_views)
-                VALUES (%(insight_date)s, %(page_views)s, %(page_impressions)s, 
-                        %(page_impressions_unique)s, %(page_post_engagements)s,
-                        %(page_posts_impressions)s, %(page_reactions)s, %(page_video_views)s)
-                ON CONFLICT (insight_date) 
-                DO UPDATE SET
-                    page_views = EXCLUDED.page_views,
-                    page_impressions = EXCLUDED.page_impressions,
-                    page_impressions_unique = EXCLUDED.page_impressions_unique,
-                    page_post_engagements = EXCLUDED.page_post_engagements,
-                    page_posts_impressions = EXCLUDED.page_posts_impressions,
-                    page_reactions = EXCLUDED.page_reactions,
-                    page_video_views = EXCLUDED.page_video_views,
-                    updated_at = CURRENT_TIMESTAMP
-            """, {
-                'insight_date': data.get('insight_date'),
-                'page_views': data.get('page_views', 0),
-                'page_impressions': data.get('page_impressions', 0),
-                'page_impressions_unique': data.get('page_impressions_unique', 0),
-                'page_post_engagements': data.get('page_post_engagements', 0),
-                'page_posts_impressions': data.get('page_posts_impressions', 0),
-                'page_reactions': data.get('page_reactions', 0),
-                'page_video_views': data.get('page_video_views', 0)
-            })
-        
-        conn.commit()
+        # Chỉ lưu active metrics; generator để execute_values lấy dần từng trang
+        rows = (
+            (data.get('insight_date'),
+             data.get('page_views', 0),
+             data.get('page_impressions', 0),
+             data.get('page_impressions_unique', 0),
+             data.get('page_post_engagements', 0),
+             data.get('page_posts_impressions', 0),
+             data.get('page_reactions', 0),
+             data.get('page_video_views', 0))
+            for data in insights_data
+        )
+        
+        # Upsert tất cả các ngày trong một statement
+        execute_values(cursor, UPSERT_PAGE_INSIGHTS_SQL, rows, page_size=500)
+        
+        if owns_conn:
+            conn.commit()
         print(f"✅ Saved {len(insights_data)} days of page insights")
         
     except Exception as e:
-        conn.rollback()
+        if owns_conn:
+            conn.rollback()
         print(f"❌ Error saving page insights: {e}")
         raise
     finally:
         cursor.close()
-        conn.close()
+        if owns_conn:
+            release_db_connection(conn)
 
-def save_page_stats(stats_data):
+# Snapshot fan count / followers của ngày hôm nay; sync nhiều lần trong ngày
+# mà số liệu không đổi thì không ghi lại dòng đó
+UPSERT_PAGE_STATS_SQL = """
+    INSERT INTO facebook_page_stats (stat_date, fan_count, followers_count)
+    VALUES (%s, %s, %s)
+    ON CONFLICT (stat_date)
+    DO UPDATE SET
+        fan_count = EXCLUDED.fan_count,
+        followers_count = EXCLUDED.followers_count,
+        created_at = CURRENT_TIMESTAMP
+    WHERE (facebook_page_stats.fan_count, facebook_page_stats.followers_count)
+        IS DISTINCT FROM (EXCLUDED.fan_count, EXCLUDED.followers_count)
+"""
+
+def save_page_stats(stats_data, conn=None):
     """
     Lưu current page stats (fan count, followers) vào database
     Thay thế cho deprecated metrics: page_fan_adds, page_fan_removes
     
     Args:
         stats_data: Dict với fan_count và followers_count
+        conn: Kết nối dùng chung (None = tự mở kết nối riêng)
     """
     if not stats_data:
         print("⚠️  No page stats data to save")
         return
     
-    conn = get_db_connection()
+    owns_conn = conn is None
+    if owns_conn:
+        conn = get_db_connection()
     cursor = conn.cursor()
     
     try:
         from datetime import date
         today = date.today()
         
-        cursor.execute("""
-            INSERT INTO facebook_page_stats (stat_date, fan_count, followers_count)
-            VALUES (%s, %s, %s)
-            ON CONFLICT (stat_date)
-            DO UPDATE SET
-                fan_count = EXCLUDED.fan_count,
-                followers_count = EXCLUDED.followers_count,
-                created_at = CURRENT_TIMESTAMP
-        """, (
+        cursor.execute(UPSERT_PAGE_STATS_SQL, (
             today,
             stats_data.get('fan_count', 0),
             stats_data.get('followers_count', 0)
         ))
         
-        conn.commit()
+        if owns_conn:
+            conn.commit()
         print(f"✅ Saved page stats (Fans: {stats_data.get('fan_count', 0):,}, Followers: {stats_data.get('followers_count', 0):,})")
         
     except Exception as e:
-        conn.rollback()
+        if owns_conn:
+            conn.rollback()
         print(f"❌ Error saving page stats: {e}")
         raise
     finally:
         cursor.close()
-        conn.close()
+        if owns_conn:
+            release_db_connection(conn)
 
-def save_post_insights(posts_data):
+# Cột của facebook_post_insights theo thứ tự insert
+POST_INSIGHT_COLUMNS = (
+    'post_id', 'post_message', 'post_type', 'created_time',
+    'post_impressions', 'post_impressions_unique', 'post_engaged_users',
+    'post_reactions', 'post_comments', 'post_shares', 'post_clicks',
+    'video_views'
+)
+_POST_INSIGHT_COLUMN_SET = frozenset(POST_INSIGHT_COLUMNS)
+_post_insight_row = itemgetter(*POST_INSIGHT_COLUMNS)
+
+# Merge từ bảng tạm tmp_posts (xem save_post_insights) sang bảng chính.
+# Feed phân trang có thể trả một post hai lần (post mới đăng giữa chừng) ->
+# DISTINCT ON để ON CONFLICT không phải cập nhật một dòng hai lần
+UPSERT_POST_INSIGHTS_SQL = f"""
+    INSERT INTO facebook_post_insights 
+    ({', '.join(POST_INSIGHT_COLUMNS)})
+    SELECT DISTINCT ON (post_id) {', '.join(POST_INSIGHT_COLUMNS)}
+    FROM tmp_posts
+    ORDER BY post_id
+    ON CONFLICT (post_id)
+    DO UPDATE SET
+        post_impressions = EXCLUDED.post_impressions,
+        post_impressions_unique = EXCLUDED.post_impressions_unique,
+        post_engaged_users = EXCLUDED.post_engaged_users,
+        post_reactions = EXCLUDED.post_reactions,
+        post_comments = EXCLUDED.post_comments,
+        post_shares = EXCLUDED.post_shares,
+        post_clicks = EXCLUDED.post_clicks,
+        video_views = EXCLUDED.video_views,
+        updated_at = CURRENT_TIMESTAMP
+"""
+
+def save_post_insights(posts_data, conn=None):
     """
     Lưu Post Insights vào database
     
     Args:
         posts_data: List of dicts với post insights
+        conn: Kết nối dùng chung (None = tự mở kết nối riêng)
     """
     if not posts_data:
         print("⚠️  No post insights data to save")
         return
     
-    conn = get_db_connection()
+    owns_conn = conn is None
+    if owns_conn:
+        conn = get_db_connection()
     cursor = conn.cursor()
     
     try:
-        for post in posts_data:
-            cursor.execute("""
-                INSERT INTO facebook_post_insights 
-                (post_id, post_message, post_type, created_time, post_impressions,
-                 post_impressions_unique, post_engaged_users, post_reactions,
-                 post_comments, post_shares, post_clicks, video_views)
-                VALUES (%(post_id)s, %(post_message)s, %(post_type)s, %(created_time)s,
-                        %(post_impressions)s, %(post_impressions_unique)s, 
-                        %(post_engaged_users)s, %(post_reactions)s,
-                        %(post_comments)s, %(post_shares)s, %(post_clicks)s, %(video_views)s)
-                ON CONFLICT (post_id)
-                DO UPDATE SET
-                    post_impressions = EXCLUDED.post_impressions,
-                    post_impressions_unique = EXCLUDED.post_impressions_unique,
-                    post_engaged_users = EXCLUDED.post_engaged_users,
-                    post_reactions = EXCLUDED.post_reactions,
-                    post_comments = EXCLUDED.post_comments,
-                    post_shares = EXCLUDED.post_shares,
-                    post_clicks = EXCLUDED.post_clicks,
-                    video_views = EXCLUDED.video_views,
-                    updated_at = CURRENT_TIMESTAMP
-            """, post)
-        
-        conn.commit()
+        # Đúng thứ tự cột, mỗi post thành một dòng CSV. Post đủ cột đi qua
+        # itemgetter, chỉ post thiếu cột mới phải .get() từng cột
+        rows = (
+            _post_insight_row(post) if _POST_INSIGHT_COLUMN_SET <= post.keys()
+            else tuple(post.get(col) for col in POST_INSIGHT_COLUMNS)
+            for post in posts_data
+        )
+        
+        # None ghi thành \N để COPY hiểu là NULL, chuỗi rỗng vẫn là ''
+        buf = io.StringIO()
+        csv.writer(buf).writerows(
+            tuple(r'\N' if value is None else value for value in row)
+            for row in rows
+        )
+        buf.seek(0)
+        
+        columns = ', '.join(POST_INSIGHT_COLUMNS)
+        
+        # COPY vào bảng tạm rồi upsert một lần sang bảng chính. Bảng tạm chỉ có
+        # đúng các cột được COPY (không kèm DEFAULT) nên COPY không phải tính
+        # default / nextval cho từng dòng
+        cursor.execute(f"""
+            CREATE TEMP TABLE tmp_posts ON COMMIT DROP AS
+            SELECT {columns} FROM facebook_post_insights
+            WITH NO DATA
+        """)
+        cursor.copy_expert(
+            f"COPY tmp_posts ({columns}) FROM STDIN WITH (FORMAT csv, NULL '\\N')", buf
+        )
+        # Câu upsert cố định: server chỉ parse/plan một lần cho mỗi kết nối
+        execute_prepared(cursor, "upsert_post_insights", UPSERT_POST_INSIGHTS_SQL)
+        
+        if owns_conn:
+            conn.commit()
         print(f"✅ Saved {len(posts_data)} posts insights")
         
     except Exception as e:
-        conn.rollback()
+        if owns_conn:
+            conn.rollback()
         print(f"❌ Error saving post insights: {e}")
         raise
     finally:
         cursor.close()
-        conn.close()
+        if owns_conn:
+            release_db_connection(conn)
+
+# Tính lại summary 7 ngày từ page insights, bỏ qua ngày không đổi
+UPSERT_METRICS_SUMMARY_SQL = """
+    INSERT INTO facebook_metrics_summary 
+    (metric_date, total_views, total_viewers, total_engagement, engagement_rate)
+    SELECT 
+        insight_date as metric_date,
+        page_views as total_views,
+        page_impressions_unique as total_viewers,
+        page_post_engagements as total_engagement,
+        CASE 
+            WHEN page_impressions > 0 
+            THEN ROUND((page_post_engagements::numeric / page_impressions::numeric) * 100, 2)
+            ELSE 0 
+        END as engagement_rate
+    FROM facebook_page_insights
+    WHERE insight_date >= CURRENT_DATE - INTERVAL '7 days'
+    ON CONFLICT (metric_date)
+    DO UPDATE SET
+        total_views = EXCLUDED.total_views,
+        total_viewers = EXCLUDED.total_viewers,
+        total_engagement = EXCLUDED.total_engagement,
+        engagement_rate = EXCLUDED.engagement_rate,
+        created_at = CURRENT_TIMESTAMP
+    WHERE (facebook_metrics_summary.total_views,
+           facebook_metrics_summary.total_viewers,
+           facebook_metrics_summary.total_engagement,
+           facebook_metrics_summary.engagement_rate)
+        IS DISTINCT FROM
+          (EXCLUDED.total_views, EXCLUDED.total_viewers,
+           EXCLUDED.total_engagement, EXCLUDED.engagement_rate)
+"""
 
-def calculate_and_save_summary_metrics():
+def calculate_and_save_summary_metrics(conn=None):
     """
     Tính toán và lưu metrics tổng hợp cho dashboard
     Sử dụng active metrics, không dùng deprecated metrics
     """
-    conn = get_db_connection()
+    owns_conn = conn is None
+    if owns_conn:
+        conn = get_db_connection()
     cursor = conn.cursor()
     
     try:
-        # Tính metrics từ page insights (chỉ dùng active metrics)
-        cursor.execute("""
-            INSERT INTO facebook_metrics_summary 
-            (metric_date, total_views, total_viewers, total_engagement, engagement_rate)
-            SELECT 
-                insight_date as metric_date,
-                page_views as total_views,
-                page_impressions_unique as total_viewers,
-                page_post_engagements as total_engagement,
-                CASE 
-                    WHEN page_impressions > 0 
-                    THEN ROUND((page_post_engagements::numeric / page_impressions::numeric) * 100, 2)
-                    ELSE 0 
-                END as engagement_rate
-            FROM facebook_page_insights
-            WHERE insight_date >= CURRENT_DATE - INTERVAL '7 days'
-            ON CONFLICT (metric_date)
-            DO UPDATE SET
-                total_views = EXCLUDED.total_views,
-                total_viewers = EXCLUDED.total_viewers,
-                total_engagement = EXCLUDED.total_engagement,
-                engagement_rate = EXCLUDED.engagement_rate,
-                created_at = CURRENT_TIMESTAMP
-        """)
+        # Tính metrics từ page insights (chỉ dùng active metrics);
+        # ngày nào số liệu không đổi thì bỏ qua, không ghi lại dòng đó
+        execute_prepared(cursor, "upsert_metrics_summary", UPSERT_METRICS_SUMMARY_SQL)
         
-        conn.commit()
+        if owns_conn:
+            conn.commit()
         print("✅ Calculated and saved summary metrics")
         
     except Exception as e:
-        conn.rollback()
+        if owns_conn:
+            conn.rollback()
         print(f"❌ Error calculating summary metrics: {e}")
         raise
     finally:
         cursor.close()
-        conn.close()
+        if owns_conn:
+            release_db_connection(conn)
 
-def calculate_fan_growth():
+def calculate_fan_growth(conn=None):
     """
     Tính toán fan growth từ daily fan count
     Thay thế cho deprecated page_fan_adds và page_fan_removes
@@ -238,27 +319,30 @@ def calculate_fan_growth():
     Returns:
         Dict với fan growth stats
     """
-    conn = get_db_connection()
+    owns_conn = conn is None
+    if owns_conn:
+        conn = get_db_connection()
     cursor = conn.cursor()
     
     try:
-        # Lấy fan count hôm nay và hôm qua
+        # Lỗi ở bước chỉ đọc này không được làm hỏng transaction dùng chung
+        if not owns_conn:
+            cursor.execute("SAVEPOINT fan_growth")
+        
+        # Lấy fan count của 2 ngày gần nhất (đi theo index của stat_date)
         cursor.execute("""
-            SELECT 
-                stat_date,
-                fan_count,
-                LAG(fan_count) OVER (ORDER BY stat_date) as previous_fan_count
+            SELECT stat_date, fan_count
             FROM facebook_page_stats
             WHERE stat_date >= CURRENT_DATE - INTERVAL '7 days'
             ORDER BY stat_date DESC
-            LIMIT 1
+            LIMIT 2
         """)
         
-        result = cursor.fetchone()
+        rows = cursor.fetchall()
         
-        if result and result[2]:  # Có data hôm qua
-            today_fans = result[1]
-            yesterday_fans = result[2]
+        if len(rows) == 2 and rows[1][1]:  # Có data hôm qua
+            today_fans = rows[0][1]
+            yesterday_fans = rows[1][1]
             fan_growth = today_fans - yesterday_fans
             
             print(f"📊 Fan Growth Analysis:")
@@ -276,64 +360,82 @@ def calculate_fan_growth():
             return None
             
     except Exception as e:
+        if not owns_conn:
+            cursor.execute("ROLLBACK TO SAVEPOINT fan_growth")
         print(f"❌ Error calculating fan growth: {e}")
         return None
     finally:
         cursor.close()
-        conn.close()
+        if owns_conn:
+            release_db_connection(conn)
 
-def get_sync_summary():
+def get_sync_summary(conn=None):
     """
     Lấy tổng kết sau khi sync
     
     Returns:
         Dict với summary stats
     """
-    conn = get_db_connection()
+    owns_conn = conn is None
+    if owns_conn:
+        conn = get_db_connection()
     cursor = conn.cursor()
     
     try:
-        summary = {}
-        
-        # Count records
-        cursor.execute("SELECT COUNT(*) FROM facebook_page_insights WHERE insight_date >= CURRENT_DATE - INTERVAL '7 days'")
-        summary['page_insights_count'] = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT COUNT(*) FROM facebook_page_stats")
-        summary['page_stats_count'] = cursor.fetchone()[0]
+        # Như calculate_fan_growth: lỗi ở đây không được làm hỏng transaction
+        # dùng chung (commit trên transaction lỗi sẽ âm thầm rollback)
+        if not owns_conn:
+            cursor.execute("SAVEPOINT sync_summary")
         
-        cursor.execute("SELECT COUNT(*) FROM facebook_post_insights WHERE created_time >= CURRENT_TIMESTAMP - INTERVAL '7 days'")
-        summary['posts_count'] = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT COUNT(*) FROM facebook_metrics_summary WHERE metric_date >= CURRENT_DATE - INTERVAL '7 days'")
-        summary['summary_count'] = cursor.fetchone()[0]
-        
-        # Get latest metrics
+        # Đếm records và tổng 7 ngày trong một query
         cursor.execute("""
-            SELECT 
-                SUM(total_views) as total_views_7d,
-                SUM(total_viewers) as total_viewers_7d,
-                SUM(total_engagement) as total_engagement_7d,
-                ROUND(AVG(engagement_rate), 2) as avg_engagement_rate
-            FROM facebook_metrics_summary
-            WHERE metric_date >= CURRENT_DATE - INTERVAL '7 days'
+            SELECT
+                (SELECT COUNT(*) FROM facebook_page_insights
+                 WHERE insight_date >= CURRENT_DATE - INTERVAL '7 days'),
+                (SELECT COUNT(*) FROM facebook_page_stats),
+                (SELECT COUNT(*) FROM facebook_post_insights
+                 WHERE created_time >= CURRENT_TIMESTAMP - INTERVAL '7 days'),
+                m.summary_count,
+                m.total_views_7d,
+                m.total_viewers_7d,
+                m.total_engagement_7d,
+                m.avg_engagement_rate
+            FROM (
+                SELECT 
+                    COUNT(*) as summary_count,
+                    -- Ép về bigint để psycopg2 trả int thay vì parse numeric -> Decimal
+                    SUM(total_views)::bigint as total_views_7d,
+                    SUM(total_viewers)::bigint as total_viewers_7d,
+                    SUM(total_engagement)::bigint as total_engagement_7d,
+                    ROUND(AVG(engagement_rate), 2) as avg_engagement_rate
+                FROM facebook_metrics_summary
+                WHERE metric_date >= CURRENT_DATE - INTERVAL '7 days'
+            ) m
         """)
         
-        metrics = cursor.fetchone()
-        if metrics:
-            summary['total_views_7d'] = metrics[0] or 0
-            summary['total_viewers_7d'] = metrics[1] or 0
-            summary['total_engagement_7d'] = metrics[2] or 0
-            summary['avg_engagement_rate'] = metrics[3] or 0
+        row = cursor.fetchone()
+        summary = {
+            'page_insights_count': row[0],
+            'page_stats_count': row[1],
+            'posts_count': row[2],
+            'summary_count': row[3],
+            'total_views_7d': row[4] or 0,
+            'total_viewers_7d': row[5] or 0,
+            'total_engagement_7d': row[6] or 0,
+            'avg_engagement_rate': row[7] or 0
+        }
         
         return summary
         
     except Exception as e:
+        if not owns_conn:
+            cursor.execute("ROLLBACK TO SAVEPOINT sync_summary")
         print(f"❌ Error getting sync summary: {e}")
         return {}
     finally:
         cursor.close()
-        conn.close()
+        if owns_conn:
+            release_db_connection(conn)
 
 def fetch_and_save_all_facebook_data():
     """
@@ -351,6 +453,9 @@ def fetch_and_save_all_facebook_data():
     print("   ❌ page_fan_removes")
     print("=" * 70)
     
+    # Một kết nối cho cả lần sync, commit một lần sau khi ghi xong
+    conn = get_db_connection()
+    
     try:
         # Khởi tạo Facebook API
         fb = FacebookAPI()
@@ -360,51 +465,63 @@ def fetch_and_save_all_facebook_data():
         if not fb.test_connection():
             raise Exception("Facebook connection failed")
         
-        # Fetch Current Page Stats (thay thế cho page_fan_adds/removes)
-        print("\n2. Fetching current page stats...")
-        stats = fb.get_page_current_stats()
-        if stats:
-            print(f"   📊 Fan Count: {stats.get('fan_count', 0):,}")
-            print(f"   📊 Followers: {stats.get('followers_count', 0):,}")
-        else:
-            print("   ⚠️  Could not fetch page stats")
-        
-        # Save Page Stats
-        print("\n3. Saving page stats to database...")
-        save_page_stats(stats)
-        
-        # Calculate Fan Growth
-        print("\n4. Calculating fan growth...")
-        fan_growth = calculate_fan_growth()
-        
-        # Fetch Page Insights (chỉ active metrics)
-        print("\n5. Fetching page insights (last 7 days)...")
-        print("   ✅ Active metrics only (no deprecated)")
-        insights_raw = fb.get_page_summary_metrics()
-        insights_formatted = format_insights_for_database(insights_raw)
-        print(f"   📊 Fetched {len(insights_formatted)} days of data")
-        
-        # Save Page Insights
-        print("\n6. Saving page insights to database...")
-        save_page_insights(insights_formatted)
-        
-        # Fetch Posts
-        print("\n7. Fetching posts with insights...")
-        posts_raw = fb.get_posts_with_insights_last_7_days()
-        posts_formatted = format_posts_for_database(posts_raw)
-        print(f"   📝 Fetched {len(posts_formatted)} posts")
+        # 3 request Graph API độc lập nhau: gửi cùng lúc, xử lý theo thứ tự
+        # dưới đây khi từng kết quả về
+        with ThreadPoolExecutor(max_workers=3) as fetcher:
+            stats_job = fetcher.submit(fb.get_page_current_stats)
+            insights_job = fetcher.submit(fb.get_page_summary_metrics)
+            posts_job = fetcher.submit(fb.get_posts_with_insights_last_7_days)
+            
+            # Fetch Current Page Stats (thay thế cho page_fan_adds/removes)
+            print("\n2. Fetching current page stats...")
+            stats = stats_job.result()
+            if stats:
+                print(f"   📊 Fan Count: {stats.get('fan_count', 0):,}")
+                print(f"   📊 Followers: {stats.get('followers_count', 0):,}")
+            else:
+                print("   ⚠️  Could not fetch page stats")
+            
+            # Các bước ghi DB chạy ngay trên main thread, trong cùng transaction,
+            # trong khi các request Graph API còn lại vẫn đang chạy ở fetcher
+            # Save Page Stats
+            print("\n3. Saving page stats to database...")
+            save_page_stats(stats, conn=conn)
+            
+            # Calculate Fan Growth
+            print("\n4. Calculating fan growth...")
+            fan_growth = calculate_fan_growth(conn=conn)
+            
+            # Fetch Page Insights (chỉ active metrics)
+            print("\n5. Fetching page insights (last 7 days)...")
+            print("   ✅ Active metrics only (no deprecated)")
+            insights_raw = insights_job.result()
+            insights_formatted = format_insights_for_database(insights_raw)
+            print(f"   📊 Fetched {len(insights_formatted)} days of data")
+            
+            # Save Page Insights
+            print("\n6. Saving page insights to database...")
+            save_page_insights(insights_formatted, conn=conn)
+            
+            # Fetch Posts
+            print("\n7. Fetching posts with insights...")
+            posts_raw = posts_job.result()
+            posts_formatted = format_posts_for_database(posts_raw)
+            print(f"   📝 Fetched {len(posts_formatted)} posts")
         
         # Save Posts
         print("\n8. Saving post insights to database...")
-        save_post_insights(posts_formatted)
+        save_post_insights(posts_formatted, conn=conn)
         
         # Calculate Summary
         print("\n9. Calculating summary metrics...")
-        calculate_and_save_summary_metrics()
+        calculate_and_save_summary_metrics(conn=conn)
         
-        # Get Summary
+        # Get Summary (cùng transaction, đọc luôn dữ liệu vừa ghi)
         print("\n10. Getting sync summary...")
-        summary = get_sync_summary()
+        summary = get_sync_summary(conn=conn)
+        
+        # Commit duy nhất của cả lần sync
+        conn.commit()
         
         print("\n" + "=" * 70)
         print("✅ FACEBOOK DATA SYNC COMPLETED SUCCESSFULLY")
@@ -427,6 +544,7 @@ def fetch_and_save_all_facebook_data():
         print("\n" + "=" * 70)
         
     except Exception as e:
+        conn.rollback()
         print("\n" + "=" * 70)
         print("❌ FACEBOOK DATA SYNC FAILED")
         print("=" * 70)
@@ -434,6 +552,8 @@ def fetch_and_save_all_facebook_data():
         import traceback
         traceback.print_exc()
         raise
+    finally:
+        release_db_connection(conn)
 
 if __name__ == "__main__":
     fetch_and_save_all_facebook_data()
\ No newline at end of file
@@ -0,0 +1,84 @@
+"""
+Expired page token during the batched token check + insights fetch
+    python -m unittest tests.test_fetch_facebook_data_with_refresh
+"""
+
+import json
+import unittest
+from unittest import mock
+
+import requests
+
+import fetch_facebook_data_with_refresh as fb_sync
+
+
+def _response(status, payload):
+    """requests.Response carrying a JSON body"""
+    response = requests.Response()
+    response.status_code = status
+    response._content = json.dumps(payload).encode()
+    return response
+
+
+EXPIRED_TOKEN_ERROR = {
+    "error": {"message": "Error validating access token: Session has expired",
+              "type": "OAuthException", "code": 190}
+}
+INSIGHTS = {"data": [{"name": "page_views_total", "period": "day",
+                      "values": [{"value": 5, "end_time": "2024-01-01T08:00:00+0000"}]}]}
+
+
+class ExpiredPageTokenTest(unittest.TestCase):
+
+    def setUp(self):
+        self.session = mock.Mock()
+        patches = [
+            mock.patch.object(fb_sync, "get_graph_session", return_value=self.session),
+            mock.patch.object(fb_sync, "_get_env", return_value="EXPIRED"),
+            mock.patch.object(fb_sync, "cached_token_is_valid", return_value=False),
+            mock.patch.object(fb_sync, "cache_verified_token"),
+            mock.patch.object(fb_sync, "get_connection"),
+            mock.patch.object(fb_sync, "release_connection"),
+            mock.patch.object(fb_sync, "_save_insights", return_value=1),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_batch_is_authorized_with_app_token(self):
+        self.session.post.return_value = _response(200, [])
+        with mock.patch.dict("os.environ", {"FACEBOOK_APP_ID": "1", "FACEBOOK_APP_SECRET": "s"}):
+            fb_sync._verify_and_fetch_insights(self.session, "v19.0", "42", "EXPIRED", {"metric": "m"})
+
+        data = self.session.post.call_args.kwargs["data"]
+        self.assertEqual(data["access_token"], "1|s")
+        insights_item = json.loads(data["batch"])[1]
+        self.assertIn("access_token=EXPIRED", insights_item["relative_url"])
+
+    def test_debug_token_reports_expired_then_refresh_runs(self):
+        # Batch succeeds, debug_token says the page token is no longer valid
+        self.session.post.return_value = _response(200, [
+            {"code": 200, "body": json.dumps({"data": {"is_valid": False}})},
+            {"code": 400, "body": json.dumps(EXPIRED_TOKEN_ERROR)},
+        ])
+        self.session.get.return_value = _response(200, INSIGHTS)
+
+        with mock.patch.object(fb_sync, "get_valid_page_token", return_value="FRESH") as refresh:
+            self.assertTrue(fb_sync.fetch_facebook_insights())
+
+        refresh.assert_called_once()
+        self.assertEqual(self.session.get.call_args.kwargs["params"]["access_token"], "FRESH")
+
+    def test_batch_rejected_then_refresh_runs(self):
+        # Graph rejects the whole batch with OAuthException 190
+        self.session.post.return_value = _response(400, EXPIRED_TOKEN_ERROR)
+        self.session.get.return_value = _response(200, INSIGHTS)
+
+        with mock.patch.object(fb_sync, "get_valid_page_token", return_value="FRESH") as refresh:
+            self.assertTrue(fb_sync.fetch_facebook_insights())
+
+        refresh.assert_called_once()
+
+
+if __name__ == "__main__":
+    unittest.main()